@@ -5,7 +5,13 @@ from datetime import datetime
 import MetaTrader5 as mt5
 import yfinance as yf
 import pandas as pd
+import contextlib
+import os
 import time
+from market_data_bus import MarketDataBus
+from live_metrics import StrategyMetrics
+from mt5_session import MT5Session
+from regime import detect_regime, TREND, MEAN_REVERSION
 
 # Define broker credentials
 broker_login = 123456  # Replace with your broker's MetaTrader login ID
@@ -17,25 +23,48 @@ symbol = "AAPL"  # Trading symbol
 lot_size = 0.1  # Lot size for each trade
 slippage = 5  # Maximum slippage allowed (points)
 
-# Initialize MetaTrader 5 and log in to your broker
+# Name of a running market data bus (python market_data_bus.py AAPL:1m) to read
+# live prices from, or None to download them from Yahoo Finance
+market_data_bus_name = None
+market_data_buses = {}  # Attached buses by channel
+
+# Check every check_interval seconds, or poll MT5 ticks instead of downloading
+# a day of 1m bars on every check
+check_interval = 300  # Seconds between live checks
+use_tick_quotes = False
+quote_poll_interval = 0.25  # Seconds between tick polls
+
+# Only run the rules that suit the market: trend following while it trends,
+# mean reversion while it reverts, both while the regime is unclear
+route_by_regime = True
+regime_window = 126  # Bars of the rolling Hurst exponent and variance ratio
+
+# Running equity and risk metrics, updated on fills and live prices. The loop
+# runs around the clock and records one return per check_interval (with tick
+# quotes too), so returns are annualized at that cadence.
+strategy_metrics = StrategyMetrics("Mean Reversion/Trend Following",
+                                   periods_per_year=365 * 24 * 3600 // check_interval)
+
+# Connection to the terminal; a heartbeat logs in again with backoff if it drops,
+# and symbol metadata is cached so orders need no extra round trip
+broker_session = MT5Session(broker_login, broker_password, broker_server)
+
+# Initialize MetaTrader 5 and log in to your broker, retrying until it succeeds
 def initialize_broker():
-    if not mt5.initialize():
-        print("MetaTrader 5 initialization failed")
-        quit()
-    else:
+    if broker_session.connect():
         print("MetaTrader 5 initialized")
-    
-    authorized = mt5.login(login=broker_login, password=broker_password, server=broker_server)
-    if authorized:
         print("Logged in to the broker successfully")
     else:
-        print(f"Failed to log in to the broker. Error code: {mt5.last_error()}")
-        quit()
+        broker_session.reconnect()
+    broker_session.start_heartbeat()
 
 # Function to place a buy order
 def place_buy_order():
     print("Placing Buy Order...")
-    tick = mt5.symbol_info_tick(symbol)
+    if not broker_session.ensure_connected(max_attempts=1):
+        print(f"Order on {symbol} not sent: no connection to MetaTrader 5")
+        return
+    tick = broker_session.call("symbol_info_tick", symbol)
     if tick is None:
         print(f"Failed to get tick data for {symbol}")
         return
@@ -43,26 +72,30 @@ def place_buy_order():
     order_request = {
         "action": mt5.TRADE_ACTION_DEAL,
         "symbol": symbol,
-        "volume": lot_size,
+        "volume": broker_session.normalize_volume(symbol, lot_size),
         "type": mt5.ORDER_TYPE_BUY,
         "price": tick.ask,
         "slippage": slippage,
         "magic": 123456,
         "comment": "Mean Reversion/Trend Following Buy Order",
         "type_time": mt5.ORDER_TIME_GTC,
-        "type_filling": mt5.ORDER_FILLING_IOC,
+        "type_filling": broker_session.filling_mode(symbol),
     }
     
-    result = mt5.order_send(order_request)
+    result = broker_session.call("order_send", order_request)
     if result.retcode == mt5.TRADE_RETCODE_DONE:
         print("Buy Order placed successfully")
+        strategy_metrics.on_fill(symbol, lot_size, result.price)
     else:
         print(f"Buy Order failed. Error code: {result.retcode}")
 
 # Function to place a sell order
 def place_sell_order():
     print("Placing Sell Order...")
-    tick = mt5.symbol_info_tick(symbol)
+    if not broker_session.ensure_connected(max_attempts=1):
+        print(f"Order on {symbol} not sent: no connection to MetaTrader 5")
+        return
+    tick = broker_session.call("symbol_info_tick", symbol)
     if tick is None:
         print(f"Failed to get tick data for {symbol}")
         return
@@ -70,28 +103,25 @@ def place_sell_order():
     order_request = {
         "action": mt5.TRADE_ACTION_DEAL,
         "symbol": symbol,
-        "volume": lot_size,
+        "volume": broker_session.normalize_volume(symbol, lot_size),
         "type": mt5.ORDER_TYPE_SELL,
         "price": tick.bid,
         "slippage": slippage,
         "magic": 123456,
         "comment": "Mean Reversion/Trend Following Sell Order",
         "type_time": mt5.ORDER_TIME_GTC,
-        "type_filling": mt5.ORDER_FILLING_IOC,
+        "type_filling": broker_session.filling_mode(symbol),
     }
     
-    result = mt5.order_send(order_request)
+    result = broker_session.call("order_send", order_request)
     if result.retcode == mt5.TRADE_RETCODE_DONE:
         print("Sell Order placed successfully")
+        strategy_metrics.on_fill(symbol, -lot_size, result.price)
     else:
         print(f"Sell Order failed. Error code: {result.retcode}")
 
-# Function to fetch historical data using Yahoo Finance API
-def fetch_historical_data(ticker):
-    print("\nFetching historical data from Yahoo Finance...")
-    data = yf.download(ticker, start="2023-01-01", end="2023-12-01", interval="1d")
-    data = data[['Adj Close']].rename(columns={'Adj Close': 'Price'})
-    
+# Calculate the mean reversion and trend following indicators
+def add_indicators(data):
     # Mean Reversion indicators
     window_size = 126  # Approx. 6 months of trading days
     data['SMA'] = data['Price'].rolling(window=window_size).mean()  # Simple Moving Average
@@ -105,8 +135,18 @@ def fetch_historical_data(ticker):
     data['ShortSMA'] = data['Price'].rolling(window=short_window).mean()
     data['LongSMA'] = data['Price'].rolling(window=long_window).mean()
     
+    # Market regime (TREND, MEAN_REVERSION or UNDECIDED)
+    data['Regime'] = detect_regime(data['Price'], regime_window)
+    
     return data
 
+# Function to fetch historical data using Yahoo Finance API
+def fetch_historical_data(ticker):
+    print("\nFetching historical data from Yahoo Finance...")
+    data = yf.download(ticker, start="2023-01-01", end="2023-12-01", interval="1d")
+    data = data[['Adj Close']].rename(columns={'Adj Close': 'Price'})
+    return add_indicators(data)
+
 # Function to fetch live data using Yahoo Finance API
 def fetch_live_data(ticker):
     print("\nFetching live data from Yahoo Finance...")
@@ -114,34 +154,145 @@ def fetch_live_data(ticker):
     live_data = live_data[['Adj Close']].rename(columns={'Adj Close': 'Price'})
     return live_data
 
+# Function to read live data from the market data bus instead of Yahoo Finance
+def fetch_live_data_from_bus(ticker):
+    print("\nReading live data from the market data bus...")
+    channel = f"{ticker}:1m"
+    if channel not in market_data_buses:
+        market_data_buses[channel] = MarketDataBus(market_data_bus_name, [channel])
+    bars = market_data_buses[channel].latest_bars(channel, 1440, copy=True)  # One day of 1m bars
+    live_data = pd.DataFrame({'Price': bars['close']}, index=pd.to_datetime(bars['time'], unit='s'))
+    return live_data
+
 # Compare historical data with live data and place orders
-def compare_historical_with_live(historical, live):
+def compare_historical_with_live(historical, live, buy=place_buy_order, sell=place_sell_order):
+    # Get the most recent live price
+    compare_historical_with_price(historical, live['Price'].iloc[-1], buy, sell)
+
+# Compare historical data with a live price and place orders
+def compare_historical_with_price(historical, live_price, buy=place_buy_order, sell=place_sell_order):
     print("\n--- Comparing Historical and Live Data ---")
     
     # Get the last row from historical data
     last_historical = historical.iloc[-1]
+    strategy_metrics.on_price(symbol, live_price)
+    regime = last_historical['Regime'] if route_by_regime and 'Regime' in historical else None
     
-    # Get the most recent live price
-    live_price = live['Price'].iloc[-1]
-    
-    # Mean Reversion Strategy
-    if live_price < last_historical['LowerBand']:
+    # Mean Reversion Strategy (skipped while the market trends)
+    if regime == TREND:
+        print("Trending regime: mean reversion rules skipped.")
+    elif live_price < last_historical['LowerBand']:
         print(f"Buy signal: Live price {live_price} below lower band ({last_historical['LowerBand']}).")
-        place_buy_order()
+        buy()
     elif live_price > last_historical['UpperBand']:
         print(f"Sell signal: Live price {live_price} above upper band ({last_historical['UpperBand']}).")
-        place_sell_order()
+        sell()
     
-    # Trend Following Strategy
+    # Trend Following Strategy (skipped while the market mean reverts)
     short_sma = historical['ShortSMA'].iloc[-1]
     long_sma = historical['LongSMA'].iloc[-1]
     
-    if short_sma > long_sma and live_price > short_sma:
+    if regime == MEAN_REVERSION:
+        print("Mean reverting regime: trend following rules skipped.")
+    elif short_sma > long_sma and live_price > short_sma:
         print(f"Trend UP signal: Live price {live_price} above Short SMA ({short_sma}) and Short SMA above Long SMA ({long_sma}).")
-        place_buy_order()
+        buy()
     elif short_sma < long_sma and live_price < short_sma:
         print(f"Trend DOWN signal: Live price {live_price} below Short SMA ({short_sma}) and Short SMA below Long SMA ({long_sma}).")
-        place_sell_order()
+        sell()
+
+# Print the running performance of this strategy
+def print_live_metrics():
+    snapshot = strategy_metrics.snapshot()
+    print(f"Equity: {snapshot['equity']:.2f} | Drawdown: {snapshot['drawdown']:.2%} | "
+          f"Max Drawdown: {snapshot['max_drawdown']:.2%} | Sharpe: {snapshot['sharpe']:.2f} | "
+          f"Exposure: {snapshot['net_exposure']:.2f}")
+
+# Run the live check every interval seconds; fetch_live, sleep and the order
+# functions can be swapped out to replay the loop against recorded data
+def run_loop(historical_data, ticker, fetch_live=fetch_live_data, sleep=time.sleep,
+             buy=place_buy_order, sell=place_sell_order, interval=check_interval, cycles=None):
+    cycle = 0
+    while cycles is None or cycle < cycles:
+        try:
+            # Fetch live data
+            live_data = fetch_live(ticker)
+            
+            # Compare historical data with live data and place orders
+            compare_historical_with_live(historical_data, live_data, buy, sell)
+        except Exception as e:
+            print(f"An error occurred: {e}")
+        
+        # One return per check, even when the check failed
+        strategy_metrics.mark()
+        print_live_metrics()
+        
+        # Sleep until the next check
+        print(f"Waiting for {interval // 60} minutes before the next check...")
+        sleep(interval)
+        cycle += 1
+
+# The latest quote of a symbol, read under the session lock so it never runs
+# while the heartbeat reconnects
+def session_tick(symbol):
+    return broker_session.call("symbol_info_tick", symbol)
+
+# Poll the latest quote every interval seconds and call on_change(tick) only when
+# the bid or ask moved, and on_poll() after every poll; source defaults to the MT5
+# terminal but any function returning an object with bid and ask (or None) can
+# stand in for it
+def poll_quotes(symbol, on_change, interval=quote_poll_interval, source=session_tick,
+                sleep=time.sleep, cycles=None, on_poll=None):
+    last_quote = None
+    missing = 0
+    cycle = 0
+    while cycles is None or cycle < cycles:
+        try:
+            tick = source(symbol)
+            if tick is None:
+                # Report the first missing quote and then about once a minute
+                if missing % max(1, round(60 / interval)) == 0:
+                    print(f"Still no quote for {symbol} after {missing} polls" if missing else
+                          f"No quote for {symbol}; is it in Market Watch?")
+                missing += 1
+            else:
+                missing = 0
+            if tick is not None and (tick.bid, tick.ask) != last_quote:
+                last_quote = (tick.bid, tick.ask)
+                on_change(tick)
+        except Exception as e:
+            print(f"An error occurred: {e}")
+        if on_poll is not None:
+            on_poll()
+        sleep(interval)
+        cycle += 1
+
+# Evaluate the strategies on every quote change. Orders are only sent when the
+# set of signals changes, otherwise every tick would resend the same orders.
+# Quotes change at irregular times, so the metrics are marked on a count of
+# polls instead: once per check_interval, as in run_loop.
+def run_quote_loop(historical_data, source=session_tick, sleep=time.sleep,
+                   buy=place_buy_order, sell=place_sell_order, cycles=None):
+    previous_orders = []
+    polls_per_mark = max(1, round(check_interval / quote_poll_interval))
+    polls = [0]
+    
+    def on_change(tick):
+        orders = []
+        compare_historical_with_price(historical_data, (tick.bid + tick.ask) / 2,
+                                      lambda: orders.append(buy), lambda: orders.append(sell))
+        if orders != previous_orders:
+            for order in orders:
+                order()
+            previous_orders[:] = orders
+    
+    def on_poll():
+        polls[0] += 1
+        if polls[0] % polls_per_mark == 0:
+            strategy_metrics.mark()
+            print_live_metrics()
+    
+    poll_quotes(symbol, on_change, quote_poll_interval, source, sleep, cycles, on_poll)
 
 # Main execution
 def main():
@@ -154,19 +305,57 @@ def main():
     historical_data = fetch_historical_data(ticker)
     
     # Continuous loop for live updates
-    while True:
-        try:
-            # Fetch live data
-            live_data = fetch_live_data(ticker)
-            
-            # Compare historical data with live data and place orders
-            compare_historical_with_live(historical_data, live_data)
-        except Exception as e:
-            print(f"An error occurred: {e}")
-        
-        # Sleep for 5 minutes
-        print("Waiting for 5 minutes before the next check...")
-        time.sleep(300)
+    if use_tick_quotes:
+        # Ticks only arrive for symbols in Market Watch; symbol_info adds it there
+        broker_session.symbol_info(symbol)
+        run_quote_loop(historical_data)
+    else:
+        run_loop(historical_data, ticker,
+                 fetch_live_data_from_bus if market_data_bus_name else fetch_live_data)
+
+# Replay the live loop on a virtual clock against recorded 1-minute prices.
+# intraday is a DataFrame with a 'Price' column and a DatetimeIndex; each cycle
+# sees that day's bars up to the virtual time, as yf.download(period="1d") would,
+# or the last session's bars when the market has not opened yet that day.
+# Orders are recorded instead of sent and returned as a DataFrame. The loop
+# updates metrics (a fresh StrategyMetrics by default) in place of the live
+# strategy_metrics, which is left untouched.
+def replay(historical_data, intraday, start, end, ticker="AAPL", interval=check_interval, verbose=False,
+           metrics=None):
+    global strategy_metrics
+    clock = {'now': pd.Timestamp(start)}
+    index = intraday.index
+    last_price = {'Price': float('nan')}
+    orders = []
+    
+    def fetch_live(ticker):
+        now = clock['now']
+        stop = index.searchsorted(now, side='right')
+        session = now.normalize() if stop == 0 else index[stop - 1].normalize()
+        live_data = intraday.iloc[index.searchsorted(session):stop]
+        if len(live_data):
+            last_price['Price'] = live_data['Price'].iloc[-1]
+        return live_data
+    
+    def sleep(seconds):
+        clock['now'] += pd.Timedelta(seconds=seconds)
+    
+    def record(side):
+        return lambda: orders.append({'time': clock['now'], 'side': side, 'price': last_price['Price']})
+    
+    cycles = int((pd.Timestamp(end) - clock['now']) / pd.Timedelta(seconds=interval)) + 1
+    live_metrics = strategy_metrics
+    strategy_metrics = metrics if metrics is not None else \
+        StrategyMetrics(live_metrics.name, window=live_metrics.window,
+                        periods_per_year=live_metrics.periods_per_year)
+    try:
+        with open(os.devnull, 'w') as devnull, \
+                (contextlib.nullcontext() if verbose else contextlib.redirect_stdout(devnull)):
+            run_loop(historical_data, ticker, fetch_live, sleep, record('buy'), record('sell'), interval, cycles)
+    finally:
+        strategy_metrics = live_metrics
+    
+    return pd.DataFrame(orders, columns=['time', 'side', 'price'])
 
 # Start the program
 if __name__ == "__main__":
@@ -6,25 +6,28 @@ import MetaTrader5 as mt5
 import yfinance as yf
 import pandas as pd
 import time
+from mt5_session import MT5Session
 
 # Define broker credentials
 broker_login = 123456  # Replace with your broker's MetaTrader login ID
 broker_password = "yourpassword"  # Replace with your broker's password
 broker_server = "yourbroker-server"  # Replace with your broker's server name
 
-# Initialize MetaTrader 5 and log in to your broker
+# Poll MT5 ticks instead of downloading a day of 1m bars every 5 minutes
+use_tick_quotes = False
+quote_poll_interval = 0.25  # Seconds between tick polls
+
+# Connection to the terminal; a heartbeat logs in again with backoff if it drops
+broker_session = MT5Session(broker_login, broker_password, broker_server)
+
+# Initialize MetaTrader 5 and log in to your broker, retrying until it succeeds
 def initialize_broker():
-    if not mt5.initialize():
-        print("MetaTrader 5 initialization failed")
-        quit()
-    else:
+    if broker_session.connect():
         print("MetaTrader 5 initialized")
-    
-    authorized = mt5.login(login=broker_login, password=broker_password, server=broker_server)
-    if authorized:
         print("Logged in to the broker successfully")
     else:
-        print(f"Failed to log in to the broker. Error code: {mt5.last_error()}")
+        broker_session.reconnect()
+    broker_session.start_heartbeat()
 
 # Function to fetch historical data from Yahoo Finance
 def fetch_historical_data(ticker):
@@ -56,14 +59,16 @@ def fetch_live_data(ticker):
 
 # Compare historical data with live data
 def compare_historical_with_live(historical, live):
+    # Get the most recent live price
+    compare_historical_with_price(historical, live['Price'].iloc[-1])
+
+# Compare historical data with a live price
+def compare_historical_with_price(historical, live_price):
     print("\n--- Comparing Historical and Live Data ---")
     
     # Get the last row from historical data
     last_historical = historical.iloc[-1]
     
-    # Get the most recent live price
-    live_price = live['Price'].iloc[-1]
-    
     # Mean Reversion Strategy
     # Check if the live price is significantly above or below the mean (SMA) using the upper and lower bands
     if live_price < last_historical['LowerBand']:
@@ -83,6 +88,38 @@ def compare_historical_with_live(historical, live):
     else:
         print("No significant trading signal detected.")
 
+# The latest quote of a symbol, read under the session lock so it never runs
+# while the heartbeat reconnects
+def session_tick(symbol):
+    return broker_session.call("symbol_info_tick", symbol)
+
+# Poll the latest quote every interval seconds and call on_change(tick) only when
+# the bid or ask moved; source defaults to the MT5 terminal but any function
+# returning an object with bid and ask (or None) can stand in for it
+def poll_quotes(symbol, on_change, interval=quote_poll_interval, source=session_tick,
+                sleep=time.sleep, cycles=None):
+    last_quote = None
+    missing = 0
+    cycle = 0
+    while cycles is None or cycle < cycles:
+        try:
+            tick = source(symbol)
+            if tick is None:
+                # Report the first missing quote and then about once a minute
+                if missing % max(1, round(60 / interval)) == 0:
+                    print(f"Still no quote for {symbol} after {missing} polls" if missing else
+                          f"No quote for {symbol}; is it in Market Watch?")
+                missing += 1
+            else:
+                missing = 0
+            if tick is not None and (tick.bid, tick.ask) != last_quote:
+                last_quote = (tick.bid, tick.ask)
+                on_change(tick)
+        except Exception as e:
+            print(f"An error occurred: {e}")
+        sleep(interval)
+        cycle += 1
+
 # Main execution
 def main():
     ticker = "AAPL"  # Stock symbol for Apple Inc.
@@ -93,6 +130,13 @@ def main():
     # Fetch historical data once
     historical_data = fetch_historical_data(ticker)
     
+    # Evaluate the signals on every quote change
+    if use_tick_quotes:
+        # Ticks only arrive for symbols in Market Watch; symbol_info adds it there
+        broker_session.symbol_info(ticker)
+        poll_quotes(ticker, lambda tick: compare_historical_with_price(historical_data, (tick.bid + tick.ask) / 2))
+        return
+    
     # Continuous loop for live updates
     while True:
         try:
@@ -2,7 +2,12 @@ from datetime import datetime
 import MetaTrader5 as mt5
 import yfinance as yf
 import pandas as pd
+import contextlib
+import os
 import time
+from market_data_bus import MarketDataBus
+from live_metrics import StrategyMetrics
+from mt5_session import MT5Session
 
 # Broker credentials
 broker_login = 123456
@@ -14,95 +19,201 @@ symbol = "AAPL"
 lot_size = 0.1
 slippage = 5
 
-# Initialize MetaTrader 5
+# Name of a running market data bus (python market_data_bus.py AAPL:1h) to read
+# prices from, or None to download them from Yahoo Finance
+market_data_bus_name = None
+market_data_buses = {}  # Attached buses by channel
+
+# Seconds between live checks
+check_interval = 300
+
+# Running equity and risk metrics, updated on fills and live prices. The loop
+# runs around the clock, so prices are marked once per check and returns are
+# annualized at that cadence.
+strategy_metrics = StrategyMetrics("Mean Reversion", periods_per_year=365 * 24 * 3600 // check_interval)
+
+# Connection to the terminal; a heartbeat logs in again with backoff if it drops,
+# and symbol metadata is cached so orders need no extra round trip
+broker_session = MT5Session(broker_login, broker_password, broker_server)
+
+# Initialize MetaTrader 5, retrying until it succeeds
 def initialize_broker():
-    if not mt5.initialize():
-        print("MetaTrader 5 initialization failed")
-        quit()
-    authorized = mt5.login(login=broker_login, password=broker_password, server=broker_server)
-    if authorized:
+    if broker_session.connect():
         print("Broker login successful")
     else:
-        print(f"Broker login failed. Error: {mt5.last_error()}")
-        quit()
+        broker_session.reconnect()
+    broker_session.start_heartbeat()
 
 # Place buy order
 def place_buy_order():
     print("Placing Buy Order...")
-    tick = mt5.symbol_info_tick(symbol)
+    if not broker_session.ensure_connected(max_attempts=1):
+        print(f"Order on {symbol} not sent: no connection to MetaTrader 5")
+        return
+    tick = broker_session.call("symbol_info_tick", symbol)
     if tick is None:
         print(f"Failed to get tick data for {symbol}")
         return
     order_request = {
         "action": mt5.TRADE_ACTION_DEAL,
         "symbol": symbol,
-        "volume": lot_size,
+        "volume": broker_session.normalize_volume(symbol, lot_size),
         "type": mt5.ORDER_TYPE_BUY,
         "price": tick.ask,
         "slippage": slippage,
         "magic": 123456,
         "comment": "Mean Reversion Buy",
         "type_time": mt5.ORDER_TIME_GTC,
-        "type_filling": mt5.ORDER_FILLING_IOC,
+        "type_filling": broker_session.filling_mode(symbol),
     }
-    result = mt5.order_send(order_request)
+    result = broker_session.call("order_send", order_request)
     print("Buy Order" + (" successful" if result.retcode == mt5.TRADE_RETCODE_DONE else f" failed. Error: {result.retcode}"))
+    if result.retcode == mt5.TRADE_RETCODE_DONE:
+        strategy_metrics.on_fill(symbol, lot_size, result.price)
 
 # Place sell order
 def place_sell_order():
     print("Placing Sell Order...")
-    tick = mt5.symbol_info_tick(symbol)
+    if not broker_session.ensure_connected(max_attempts=1):
+        print(f"Order on {symbol} not sent: no connection to MetaTrader 5")
+        return
+    tick = broker_session.call("symbol_info_tick", symbol)
     if tick is None:
         print(f"Failed to get tick data for {symbol}")
         return
     order_request = {
         "action": mt5.TRADE_ACTION_DEAL,
         "symbol": symbol,
-        "volume": lot_size,
+        "volume": broker_session.normalize_volume(symbol, lot_size),
         "type": mt5.ORDER_TYPE_SELL,
         "price": tick.bid,
         "slippage": slippage,
         "magic": 123456,
         "comment": "Mean Reversion Sell",
         "type_time": mt5.ORDER_TIME_GTC,
-        "type_filling": mt5.ORDER_FILLING_IOC,
+        "type_filling": broker_session.filling_mode(symbol),
     }
-    result = mt5.order_send(order_request)
+    result = broker_session.call("order_send", order_request)
     print("Sell Order" + (" successful" if result.retcode == mt5.TRADE_RETCODE_DONE else f" failed. Error: {result.retcode}"))
+    if result.retcode == mt5.TRADE_RETCODE_DONE:
+        strategy_metrics.on_fill(symbol, -lot_size, result.price)
 
-# Fetch data and calculate indicators for mean reversion 
-def fetch_data(ticker):
-    print("Fetching historical data...")
-    data = yf.download(ticker, period="1mo", interval="1h")
-    data = data[['Adj Close']].rename(columns={'Adj Close': 'Price'})
+# Calculate indicators of mean reversion
+def add_indicators(data):
     data['SMA'] = data['Price'].rolling(window=20).mean()
     data['StdDev'] = data['Price'].rolling(window=20).std()
     data['UpperBand'] = data['SMA'] + 2 * data['StdDev']
     data['LowerBand'] = data['SMA'] - 2 * data['StdDev']
     return data
 
+# Fetch data and calculate indicators for mean reversion 
+def fetch_data(ticker):
+    print("Fetching historical data...")
+    data = yf.download(ticker, period="1mo", interval="1h")
+    data = data[['Adj Close']].rename(columns={'Adj Close': 'Price'})
+    return add_indicators(data)
+
+# Read data from the market data bus instead of Yahoo Finance
+def fetch_data_from_bus(ticker):
+    print("Reading historical data from the market data bus...")
+    channel = f"{ticker}:1h"
+    if channel not in market_data_buses:
+        market_data_buses[channel] = MarketDataBus(market_data_bus_name, [channel])
+    bars = market_data_buses[channel].latest_bars(channel, 24 * 31, copy=True)
+    data = pd.DataFrame({'Price': bars['close']}, index=pd.to_datetime(bars['time'], unit='s'))
+    data = data[data.index > data.index[-1] - pd.DateOffset(months=1)]
+    return add_indicators(data)
+
 # Check conditions and place orders
-def check_conditions(data):
+def check_conditions(data, buy=place_buy_order, sell=place_sell_order):
     live_price = data['Price'].iloc[-1]
+    strategy_metrics.on_price(symbol, live_price)
     upper_band = data['UpperBand'].iloc[-1]
     lower_band = data['LowerBand'].iloc[-1]
     if live_price > upper_band:
         print(f"Sell signal: {live_price} > Upper Band ({upper_band})")
-        place_sell_order()
+        sell()
     elif live_price < lower_band:
         print(f"Buy signal: {live_price} < Lower Band ({lower_band})")
-        place_buy_order()
+        buy()
 
-# Main loop
-def main():
-    initialize_broker()
-    while True:
+# Print the running performance of this strategy
+def print_live_metrics():
+    snapshot = strategy_metrics.snapshot()
+    print(f"Equity: {snapshot['equity']:.2f} | Drawdown: {snapshot['drawdown']:.2%} | "
+          f"Max Drawdown: {snapshot['max_drawdown']:.2%} | Sharpe: {snapshot['sharpe']:.2f} | "
+          f"Exposure: {snapshot['net_exposure']:.2f}")
+
+# Run the check every interval seconds; fetch, sleep and the order functions
+# can be swapped out to replay the loop against recorded data
+def run_loop(fetch=fetch_data, sleep=time.sleep, buy=place_buy_order, sell=place_sell_order,
+             interval=check_interval, cycles=None):
+    cycle = 0
+    while cycles is None or cycle < cycles:
         try:
-            data = fetch_data(symbol)
-            check_conditions(data)
+            data = fetch(symbol)
+            check_conditions(data, buy, sell)
         except Exception as e:
             print(f"Error: {e}")
-        time.sleep(300)
+        # One return per check, even when the check failed
+        strategy_metrics.mark()
+        print_live_metrics()
+        sleep(interval)
+        cycle += 1
+
+# Main loop
+def main():
+    initialize_broker()
+    run_loop(fetch_data_from_bus if market_data_bus_name else fetch_data)
+
+# Replay the loop on a virtual clock against recorded prices. prices is a
+# DataFrame with a 'Price' column and a DatetimeIndex; each cycle sees the
+# month of bars up to the virtual time, as yf.download(period="1mo") would.
+# Orders are recorded instead of sent and returned as a DataFrame. The loop
+# updates metrics (a fresh StrategyMetrics by default) in place of the live
+# strategy_metrics, which is left untouched.
+def replay(prices, start, end, interval=check_interval, verbose=False,
+           metrics=None):
+    global strategy_metrics
+    clock = {'now': pd.Timestamp(start)}
+    index = prices.index
+    last_price = {'Price': float('nan')}
+    orders = []
+    
+    windows = {}
+    
+    def fetch(ticker):
+        now = clock['now']
+        bounds = (index.searchsorted(now - pd.DateOffset(months=1), side='right'),
+                  index.searchsorted(now, side='right'))
+        # Cycles between two bars see the same window, so compute its indicators once
+        if bounds not in windows:
+            windows.clear()
+            windows[bounds] = add_indicators(prices.iloc[bounds[0]:bounds[1]][['Price']].copy())
+        data = windows[bounds]
+        if len(data):
+            last_price['Price'] = data['Price'].iloc[-1]
+        return data
+    
+    def sleep(seconds):
+        clock['now'] += pd.Timedelta(seconds=seconds)
+    
+    def record(side):
+        return lambda: orders.append({'time': clock['now'], 'side': side, 'price': last_price['Price']})
+    
+    cycles = int((pd.Timestamp(end) - clock['now']) / pd.Timedelta(seconds=interval)) + 1
+    live_metrics = strategy_metrics
+    strategy_metrics = metrics if metrics is not None else \
+        StrategyMetrics(live_metrics.name, window=live_metrics.window,
+                        periods_per_year=live_metrics.periods_per_year)
+    try:
+        with open(os.devnull, 'w') as devnull, \
+                (contextlib.nullcontext() if verbose else contextlib.redirect_stdout(devnull)):
+            run_loop(fetch, sleep, record('buy'), record('sell'), interval, cycles)
+    finally:
+        strategy_metrics = live_metrics
+    
+    return pd.DataFrame(orders, columns=['time', 'side', 'price'])
 
 if __name__ == "__main__":
     main()
@@ -1,12 +1,33 @@
 import pandas as pd
 import numpy as np
 import MetaTrader5 as mt5
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from market_data_bus import MarketDataBus
+from mt5_session import MT5Session
+# The backtest engine (no MT5 needed) lives in backtest.py; its functions stay
+# importable from here
+from backtest import (calculate_atr, trend_following_columns, trend_following_strategy,
+                      performance_metrics, print_performance, new_profiler, profile_stage,
+                      stop_profiler, write_profile, backtest_strategy, iter_ohlcv_chunks,
+                      trend_following_chunks, streaming_backtest, band_strategy, crossover_strategy,
+                      regime_strategy, sma_matrix, evaluate_crossover_grid, optimize_strategy,
+                      build_sparse_table, query_range_extreme, rolling_extreme, donchian_breakouts,
+                      backtest_cache_key, cached_backtest, new_pair_state, update_pair_state,
+                      pairs_strategy, scan_pairs, sweep_job)
+
+# Market data buses attached by get_bus_data, by (bus name, channel)
+market_data_buses = {}
+
+# The terminal connection, kept alive and reconnected by mt5_login
+mt5_session = MT5Session()
 
 def mt5_login(login, password, server="MetaQuotes-Demo"):
     """
     Initializes and logs in to the MT5 terminal.
     
+    The credentials are kept by mt5_session, which logs in again on its
+    own whenever the heartbeat finds the connection lost.
+    
     Args:
         login (int): The MT5 account login ID.
         password (str): The MT5 account password.
@@ -15,18 +36,16 @@ def mt5_login(login, password, server="MetaQuotes-Demo"):
     Returns:
         bool: True if login is successful, False otherwise.
     """
-    if not mt5.initialize():
-        print("MT5 initialization failed")
-        return False
-        
     # Login to MT5
-    login_result = mt5.login(login=login, 
-                           password=password,
-                           server=server)
+    mt5_session.login = login
+    mt5_session.password = password
+    mt5_session.server = server
+    login_result = mt5_session.connect()
     
     if login_result:
+        mt5_session.start_heartbeat()
         print("MT5 login successful")
-        account_info = mt5.account_info()
+        account_info = mt5_session.call("account_info")
         if account_info is not None:
             print(f"Account: {account_info.login}")
             print(f"Balance: {account_info.balance}")
@@ -34,7 +53,6 @@ def mt5_login(login, password, server="MetaQuotes-Demo"):
         return True
     else:
         print("MT5 login failed")
-        mt5.shutdown()
         return False
 
 def get_mt5_data(symbol, timeframe=mt5.TIMEFRAME_D1, number_of_bars=1000):
@@ -50,115 +68,148 @@ def get_mt5_data(symbol, timeframe=mt5.TIMEFRAME_D1, number_of_bars=1000):
         pd.DataFrame: A DataFrame containing the historical data.
     """
     # Get the bars
-    bars = mt5.copy_rates_from_pos(symbol, timeframe, 0, number_of_bars)
+    bars = mt5_session.call("copy_rates_from_pos", symbol, timeframe, 0, number_of_bars)
     
     # Convert to DataFrame
     df = pd.DataFrame(bars)
     df['time'] = pd.to_datetime(df['time'], unit='s')
     
     # Rename columns to match the strategy's requirements
-    df = df.rename(columns={'time': 'date',
-                          'open': 'open',
-                          'high': 'high',
-                          'low': 'low',
-                          'close': 'close'})
+    df.rename(columns={'time': 'date'}, inplace=True)
     
     return df
 
-def calculate_atr(high, low, close, period=42):
+def get_closed_mt5_data(symbol, timeframe=mt5.TIMEFRAME_D1, number_of_bars=1000, since=None):
     """
-    Calculates the Average True Range (ATR).
+    Gets closed bars from MT5, without the bar that is still forming.
     
     Args:
-        high (pd.Series): The series of high prices.
-        low (pd.Series): The series of low prices.
-        close (pd.Series): The series of close prices.
-        period (int): The ATR calculation period.
+        symbol (str): The financial instrument symbol (e.g., "EURUSD").
+        timeframe (int): The MT5 timeframe constant (e.g., mt5.TIMEFRAME_D1).
+        number_of_bars (int): The number of bars to retrieve when since is None.
+        since (pd.Timestamp): Optional open time of the last bar already
+            seen; all bars closed after it are returned, however many.
         
     Returns:
-        pd.Series: The calculated ATR values.
+        pd.DataFrame: The bars with the same columns as get_mt5_data, or
+            None if MT5 returned no data.
     """
-    high = pd.Series(high)
-    low = pd.Series(low)
-    close = pd.Series(close)
+    if since is None:
+        # Position 0 is the forming bar
+        bars = mt5_session.call("copy_rates_from_pos", symbol, timeframe, 1, number_of_bars)
+    else:
+        forming = mt5_session.call("copy_rates_from_pos", symbol, timeframe, 0, 1)
+        if forming is None or len(forming) == 0:
+            bars = None
+        else:
+            start = int(pd.Timestamp(since).timestamp()) + 1
+            end = int(forming['time'][0]) - 1
+            bars = (mt5_session.call("copy_rates_range", symbol, timeframe,
+                                      datetime.fromtimestamp(start, tz=timezone.utc),
+                                      datetime.fromtimestamp(end, tz=timezone.utc))
+                    if end >= start else forming[:0])
+    if bars is None:
+        print(f"Failed to get rates for {symbol}. Error code: {mt5.last_error()}")
+        return None
     
-    # Calculate True Range
-    tr1 = high - low
-    tr2 = abs(high - close.shift())
-    tr3 = abs(low - close.shift())
+    df = pd.DataFrame(bars)
+    df['time'] = pd.to_datetime(df['time'], unit='s')
+    df.rename(columns={'time': 'date'}, inplace=True)
     
-    tr = pd.concat([tr1, tr2, tr3], axis=1).max(axis=1)
-    atr = tr.rolling(window=period).mean()
+    return df
+
+def rate_columns(bars):
+    """
+    Exposes the fields of an MT5 rates record array as zero-copy column views.
     
-    return atr
+    Args:
+        bars (np.ndarray): The structured array returned by copy_rates_from_pos
+            or copy_rates_range.
+        
+    Returns:
+        dict: Views of the time (int64 epoch seconds), open, high, low, close
+            and tick_volume fields, sharing memory with bars.
+    """
+    return {name: bars[name] for name in ('time', 'open', 'high', 'low', 'close', 'tick_volume')}
 
-def trend_following_strategy(df):
+def get_mt5_rates(symbol, timeframe=mt5.TIMEFRAME_D1, number_of_bars=1000):
     """
-    Implements a trend following strategy based on new all-time highs
-    with an ATR-based profit target.
+    Gets historical data from MT5 as column views of the returned rates array.
+    
+    Unlike get_mt5_data no DataFrame is built, so no column is copied;
+    the views can be passed straight to calculate_atr and
+    trend_following_columns.
     
     Args:
-        df (pd.DataFrame): The DataFrame with OHLCV data.
+        symbol (str): The financial instrument symbol (e.g., "EURUSD").
+        timeframe (int): The MT5 timeframe constant (e.g., mt5.TIMEFRAME_D1).
+        number_of_bars (int): The number of historical bars to retrieve.
         
     Returns:
-        pd.DataFrame: The DataFrame with added strategy signals and metrics.
+        dict: The column views from rate_columns, or None if MT5 returned no data.
     """
-    # Create copy of dataframe
-    signals = df.copy()
-    
-    # Calculate ATR
-    signals['ATR'] = calculate_atr(signals['high'], 
-                                 signals['low'], 
-                                 signals['close'])
-    
-    # Calculate running maximum (all-time high)
-    signals['running_max'] = signals['high'].expanding().max()
-    
-    # Generate entry signals (a new high is a potential entry)
-    signals['new_high'] = signals['running_max'] != signals['running_max'].shift(1)
-    signals['entry_signal'] = signals['new_high'].shift(1)
-    
-    # Calculate profit target (10 * ATR above entry price)
-    signals['profit_target'] = np.nan
-    
-    # Initialize position tracking
-    signals['position'] = 0
-    signals['entry_price'] = np.nan
-    
-    # Track active trades
-    current_position = 0
-    current_target = np.nan
-    current_entry = np.nan
-    
-    for i in range(1, len(signals)):
-        if signals['entry_signal'].iloc[i] and current_position == 0:
-            # Enter new position
-            current_position = 1
-            current_entry = signals['open'].iloc[i]
-            # Set profit target
-            current_target = current_entry + (10 * signals['ATR'].iloc[i])
-            
-        if current_position == 1:
-            # Check if profit target is hit
-            if signals['high'].iloc[i] >= current_target:
-                # Profit target hit
-                current_position = 0
-                current_target = np.nan
-                current_entry = np.nan
-            
-        signals['position'].iloc[i] = current_position
-        signals['profit_target'].iloc[i] = current_target
-        signals['entry_price'].iloc[i] = current_entry
+    bars = mt5_session.call("copy_rates_from_pos", symbol, timeframe, 0, number_of_bars)
+    if bars is None:
+        print(f"Failed to get rates for {symbol}. Error code: {mt5.last_error()}")
+        return None
+    return rate_columns(bars)
+
+def get_bus_data(channel, bus_name="market_data", number_of_bars=1000):
+    """
+    Gets historical data from a running market data bus instead of MT5.
+    
+    Start the feed with e.g. python market_data_bus.py --mt5 EURUSD:1d so
+    several strategy processes share one MT5 download.
     
-    # Calculate returns
-    signals['returns'] = np.where(signals['position'].shift(1) == 1,
-                                signals['close'] / signals['close'].shift(1) - 1,
-                                0)
+    Args:
+        channel (str): The bus channel (e.g., "EURUSD:1d").
+        bus_name (str): The name of the bus.
+        number_of_bars (int): The number of historical bars to retrieve.
+        
+    Returns:
+        pd.DataFrame: A DataFrame with the same columns as get_mt5_data.
+    """
+    key = (bus_name, channel)
+    if key not in market_data_buses:
+        market_data_buses[key] = MarketDataBus(bus_name, [channel])
+    bars = market_data_buses[key].latest_bars(channel, number_of_bars, copy=True)
+    
+    return pd.DataFrame({'date': pd.to_datetime(bars['time'], unit='s'),
+                         'open': bars['open'],
+                         'high': bars['high'],
+                         'low': bars['low'],
+                         'close': bars['close'],
+                         'tick_volume': bars['volume']})
+
+def make_intrabar_fetcher(symbol, timeframe=mt5.TIMEFRAME_M1):
+    """
+    Creates a cached fetcher of lower-timeframe bars for single days.
     
-    # Calculate cumulative returns
-    signals['cumulative_returns'] = (1 + signals['returns']).cumprod()
+    Bars are only requested from MT5 the first time a day is asked for,
+    so a backtest reads just the days it needs to resolve.
     
-    return signals
+    Args:
+        symbol (str): The financial instrument symbol.
+        timeframe (int): The MT5 timeframe constant of the intrabar data.
+        
+    Returns:
+        callable: fetch(day) returning a DataFrame with time, open and high
+            columns for that day.
+    """
+    cache = {}
+    
+    def fetch(day):
+        day = pd.Timestamp(day).normalize()
+        if day not in cache:
+            bars = mt5_session.call("copy_rates_range", symbol, timeframe,
+                                    day.to_pydatetime(),
+                                    (day + timedelta(days=1)).to_pydatetime())
+            bars = pd.DataFrame(bars, columns=['time', 'open', 'high', 'low', 'close'])
+            bars['time'] = pd.to_datetime(bars['time'], unit='s')
+            cache[day] = bars
+        return cache[day]
+    
+    return fetch
 
 def place_mt5_order(symbol, order_type, volume, price=0.0, comment="Trend Following"):
     """
@@ -172,27 +223,31 @@ def place_mt5_order(symbol, order_type, volume, price=0.0, comment="Trend Follow
         comment (str): A comment for the trade.
         
     Returns:
-        mt5.TradeResult: The result of the order operation.
+        mt5.TradeResult: The result of the order operation, or None if
+            the terminal is unreachable or the request was rejected.
     """
-    point = mt5.symbol_info(symbol).point
+    # Volume step and filling mode come from the session's symbol cache
+    if not mt5_session.ensure_connected(max_attempts=1):
+        print(f"Order on {symbol} not sent: no connection to MT5")
+        return None
     
     request = {
         "action": mt5.TRADE_ACTION_DEAL,
         "symbol": symbol,
-        "volume": volume,
+        "volume": mt5_session.normalize_volume(symbol, volume),
         "type": order_type,
         "price": price,
         "deviation": 20,
         "magic": 234000,
         "comment": comment,
         "type_time": mt5.ORDER_TIME_GTC,
-        "type_filling": mt5.ORDER_FILLING_IOC,
+        "type_filling": mt5_session.filling_mode(symbol),
     }
     
-    result = mt5.order_send(request)
+    result = mt5_session.call("order_send", request)
     return result
 
-def live_trading(symbol, timeframe=mt5.TIMEFRAME_D1, volume=0.1):
+def live_trading(symbol, timeframe=mt5.TIMEFRAME_D1, volume=0.1, metrics=None):
     """
     Runs the strategy live and places orders on MT5 based on signals.
     
@@ -200,9 +255,14 @@ def live_trading(symbol, timeframe=mt5.TIMEFRAME_D1, volume=0.1):
         symbol (str): The financial instrument symbol.
         timeframe (int): The MT5 timeframe constant.
         volume (float): The trade volume.
+        metrics (live_metrics.StrategyMetrics): Optional tracker that is
+            marked to the latest close once per call and fed the fills.
     """
     # Get latest data
     df = get_mt5_data(symbol, timeframe)
+    if metrics is not None:
+        metrics.on_price(symbol, df['close'].iloc[-1])
+        metrics.mark()
     
     # Run strategy
     signals = trend_following_strategy(df)
@@ -218,8 +278,10 @@ def live_trading(symbol, timeframe=mt5.TIMEFRAME_D1, volume=0.1):
                                mt5.ORDER_TYPE_BUY, 
                                volume, 
                                comment="Trend Following Entry")
-        if result.retcode == mt5.TRADE_RETCODE_DONE:
+        if result is not None and result.retcode == mt5.TRADE_RETCODE_DONE:
             print(f"Buy order placed successfully at {result.price}")
+            if metrics is not None:
+                metrics.on_fill(symbol, volume, result.price)
             
     elif current_position == 0 and previous_position == 1:
         # Exit signal (close an open long position)
@@ -227,44 +289,136 @@ def live_trading(symbol, timeframe=mt5.TIMEFRAME_D1, volume=0.1):
                                mt5.ORDER_TYPE_SELL, 
                                volume, 
                                comment="Trend Following Exit")
-        if result.retcode == mt5.TRADE_RETCODE_DONE:
+        if result is not None and result.retcode == mt5.TRADE_RETCODE_DONE:
             print(f"Sell order placed successfully at {result.price}")
+            if metrics is not None:
+                metrics.on_fill(symbol, -volume, result.price)
+
+def _send_pair_leg(symbol, quantity, comment, metrics=None):
+    """
+    Sends a market order for one leg of a pair.
+    
+    Args:
+        symbol (str): The symbol to trade.
+        quantity (float): The signed volume (negative to sell).
+        comment (str): A comment for the trade.
+        metrics (live_metrics.StrategyMetrics): Optional tracker fed the fill.
+        
+    Returns:
+        bool: True if the order was filled.
+    """
+    order_type = mt5.ORDER_TYPE_BUY if quantity > 0 else mt5.ORDER_TYPE_SELL
+    result = place_mt5_order(symbol, order_type, abs(quantity), comment=comment)
+    if result is None or result.retcode != mt5.TRADE_RETCODE_DONE:
+        print(f"{comment} order on {symbol} failed. Error code: {mt5.last_error() if result is None else result.retcode}")
+        return False
+    print(f"{comment} order on {symbol} placed successfully at {result.price}")
+    if metrics is not None:
+        metrics.on_fill(symbol, quantity, result.price)
+    return True
 
-def backtest_strategy(df):
+def pairs_trading(y_symbol, x_symbol, timeframe=mt5.TIMEFRAME_D1, volume=0.1, window=60,
+                  entry_z=2.0, exit_z=0.5, state=None, metrics=None):
     """
-    Runs a backtest on the strategy and prints performance metrics.
+    Runs the pairs strategy live and places orders for both legs on MT5.
+    
+    Call it once per bar with the same state dict. The first call warms
+    the rolling statistics up from history; later calls only fetch the
+    bars closed since the previous call and update them in constant time.
+    The bar still forming is never used.
+    
+    The x leg volume is volume * hedge ratio, which assumes both symbols
+    have the same contract size.
     
     Args:
-        df (pd.DataFrame): The DataFrame with OHLCV data.
+        y_symbol (str): The dependent symbol.
+        x_symbol (str): The hedge symbol.
+        timeframe (int): The MT5 timeframe constant.
+        volume (float): The trade volume of the y leg.
+        window (int): The rolling regression window.
+        entry_z (float): The z-score that opens a position.
+        exit_z (float): The z-score that closes it.
+        state (dict): The pair state kept between calls; pass an empty
+            dict on the first call.
+        metrics (live_metrics.StrategyMetrics): Optional tracker that is
+            marked to the latest closes once per call and fed the fills.
         
     Returns:
-        pd.DataFrame: The DataFrame with backtest results.
+        dict: The state to pass to the next call.
     """
-    results = trend_following_strategy(df)
-    
-    # Calculate metrics
-    total_returns = results['cumulative_returns'].iloc[-1] - 1
-    annual_returns = (1 + total_returns) ** (252 / len(results)) - 1
-    
-    # Calculate maximum drawdown
-    rolling_max = results['cumulative_returns'].expanding().max()
-    drawdowns = results['cumulative_returns'] / rolling_max - 1
-    max_drawdown = drawdowns.min()
-    
-    # Calculate win rate
-    trades = results[results['position'] != results['position'].shift(1)]
-    # A complete trade is an entry and an exit, so divide by 2
-    total_trades = len(trades) / 2  
-    wins = len(trades[trades['returns'] > 0])
-    win_rate = wins / total_trades if total_trades > 0 else 0
-    
-    print(f"Total Return: {total_returns:.2%}")
-    print(f"Annualized Return: {annual_returns:.2%}")
-    print(f"Maximum Drawdown: {max_drawdown:.2%}")
-    print(f"Win Rate: {win_rate:.2%}")
-    print(f"Total Trades: {total_trades:.0f}")
-    
-    return results
+    if state is None:
+        state = {}
+    if 'pair' not in state:
+        state.update({'pair': new_pair_state(window), 'last_date': None,
+                      'position': 0, 'x_quantity': 0.0, 'closing': False})
+    
+    # Only the bars closed since the last call are needed once warmed up
+    y_bars = get_closed_mt5_data(y_symbol, timeframe, 1000, state['last_date'])
+    x_bars = get_closed_mt5_data(x_symbol, timeframe, 1000, state['last_date'])
+    if y_bars is None or x_bars is None:
+        return state
+    bars = pd.merge(y_bars[['date', 'close']], x_bars[['date', 'close']],
+                    on='date', suffixes=('_y', '_x'))
+    if state['last_date'] is not None:
+        bars = bars[bars['date'] > state['last_date']]
+    if bars.empty:
+        return state
+    
+    for y, x in zip(bars['close_y'].tolist(), bars['close_x'].tolist()):
+        beta, spread, zscore = update_pair_state(state['pair'], y, x)
+    state['last_date'] = bars['date'].iloc[-1]
+    if metrics is not None:
+        # Both legs are revalued before the one return of this bar is recorded
+        metrics.on_price(y_symbol, y)
+        metrics.on_price(x_symbol, x)
+        metrics.mark()
+    
+    # Same rules as _pair_positions; between exit_z and entry_z the position is kept
+    position = state['position']
+    if zscore < -entry_z:
+        target = 1
+    elif zscore > entry_z:
+        target = -1
+    elif abs(zscore) < exit_z:
+        target = 0
+    else:
+        target = position
+    print(f"Hedge ratio: {beta:.4f} | Spread: {spread:.5f} | Z-score: {zscore:.2f}")
+    if target == position and not state['closing']:
+        return state
+    
+    # Close the open spread, then open the new one at the current hedge ratio.
+    # A leg whose exit failed stays in the state and is closed again on the
+    # next call; no new spread is opened until both legs are flat.
+    if position != 0 or state['x_quantity']:
+        state['closing'] = True
+        if position != 0 and _send_pair_leg(y_symbol, -position * volume, "Pairs Exit", metrics):
+            state['position'] = 0
+        if state['x_quantity'] and _send_pair_leg(x_symbol, -state['x_quantity'], "Pairs Exit", metrics):
+            state['x_quantity'] = 0.0
+        if state['position'] != 0 or state['x_quantity']:
+            return state
+        state['closing'] = False
+    if target != 0:
+        x_volume = round(volume * abs(beta), 2)
+        if x_volume <= 0:
+            print(f"Pairs entry skipped: the {x_symbol} hedge volume rounds to zero "
+                  f"(hedge ratio {beta:.4f})")
+            return state
+        if _send_pair_leg(y_symbol, target * volume, "Pairs Entry", metrics):
+            state['position'] = target
+            x_quantity = -target * np.sign(beta) * x_volume
+            if _send_pair_leg(x_symbol, x_quantity, "Pairs Entry", metrics):
+                state['x_quantity'] = x_quantity
+            else:
+                # Never hold the y leg unhedged: unwind it now, or on the next
+                # call through the exit path if the unwind fails too
+                state['closing'] = True
+                if _send_pair_leg(y_symbol, -target * volume, "Pairs Unwind", metrics):
+                    state['position'] = 0
+                    state['closing'] = False
+    
+    return state
 
 # Main execution block
 if __name__ == "__main__":
@@ -290,4 +444,4 @@ if __name__ == "__main__":
         live_trading(symbol)
         
         # Shutdown the MT5 connection when done
-        mt5.shutdown()
+        mt5_session.shutdown()
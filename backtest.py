@@ -0,0 +1,1483 @@
+import contextlib
+import hashlib
+import inspect
+import itertools
+import json
+import os
+import time
+import tracemalloc
+from collections import deque
+import pandas as pd
+import numpy as np
+from regime import detect_regime, route_positions
+
+# The backtest engine of Version 1.2.py: strategies, metrics, profiling,
+# streaming, parameter search, the result cache and the pairs statistics.
+# Nothing here needs the MetaTrader 5 terminal, so sweep workers and
+# research machines without MT5 (it only runs on Windows) can import it;
+# data comes in as DataFrames or OHLC columns from any source.
+
+def calculate_atr(high, low, close, period=42):
+    """
+    Calculates the Average True Range (ATR).
+    
+    Args:
+        high (pd.Series or np.ndarray): The series of high prices.
+        low (pd.Series or np.ndarray): The series of low prices.
+        close (pd.Series or np.ndarray): The series of close prices.
+        period (int): The ATR calculation period.
+        
+    Returns:
+        pd.Series: The calculated ATR values.
+    """
+    high = pd.Series(high)
+    low = pd.Series(low)
+    close = pd.Series(close)
+    
+    # Calculate True Range (fmax skips the missing previous close like a row max)
+    tr1 = high - low
+    tr2 = abs(high - close.shift())
+    tr3 = abs(low - close.shift())
+    
+    tr = np.fmax(tr1, np.fmax(tr2, tr3))
+    atr = tr.rolling(window=period).mean()
+    
+    return atr
+
+def _trend_following_positions(open_, high, atr, entry_signal, state, start=0):
+    """
+    Runs the bar-by-bar position loop of the trend following strategy.
+    
+    Args:
+        open_ (np.ndarray): The open prices.
+        high (np.ndarray): The high prices.
+        atr (np.ndarray): The ATR values aligned with the prices.
+        entry_signal (np.ndarray): Boolean entry signals aligned with the prices.
+        state (dict): The open trade ('position', 'target', 'entry', 'target_multiple'),
+            updated in place so the loop can continue on the next block of bars.
+            If it holds an 'exits' list, every profit target hit is appended
+            to it as (bar, target, entered on the same bar).
+        start (int): The first bar to evaluate; earlier bars stay flat.
+        
+    Returns:
+        tuple: The position, profit target and entry price arrays.
+    """
+    n = len(open_)
+    position = np.zeros(n, dtype=np.int64)
+    profit_target = np.full(n, np.nan)
+    entry_price = np.full(n, np.nan)
+    
+    open_ = np.asarray(open_, dtype=float).tolist()
+    high = np.asarray(high, dtype=float).tolist()
+    atr = np.asarray(atr, dtype=float).tolist()
+    entry_signal = np.asarray(entry_signal, dtype=bool).tolist()
+    
+    current_position = state['position']
+    current_target = state['target']
+    current_entry = state['entry']
+    target_multiple = state['target_multiple']
+    exits = state.get('exits')
+    
+    for i in range(start, n):
+        entered = False
+        if entry_signal[i] and current_position == 0:
+            # Enter new position
+            entered = True
+            current_position = 1
+            current_entry = open_[i]
+            # Set profit target
+            current_target = current_entry + (target_multiple * atr[i])
+            
+        if current_position == 1:
+            # Check if profit target is hit
+            if high[i] >= current_target:
+                # Profit target hit
+                if exits is not None:
+                    exits.append((i, current_target, entered))
+                current_position = 0
+                current_target = np.nan
+                current_entry = np.nan
+            
+        position[i] = current_position
+        profit_target[i] = current_target
+        entry_price[i] = current_entry
+    
+    state['position'] = current_position
+    state['target'] = current_target
+    state['entry'] = current_entry
+    
+    return position, profit_target, entry_price
+
+def trend_following_columns(columns, atr_period=42, target_multiple=10, exits=None,
+                            profiler=None):
+    """
+    Calculates the trend following signals from OHLC columns.
+    
+    The input columns are only read, so they can be views from
+    get_mt5_rates as well as DataFrame columns.
+    
+    Args:
+        columns (dict or pd.DataFrame): The open, high, low and close columns.
+        atr_period (int): The ATR calculation period.
+        target_multiple (float): The profit target as a multiple of ATR.
+        exits (list): Optional list that collects every profit target hit
+            as (bar, target, entered on the same bar).
+        profiler (dict): Optional profiler from new_profiler that times
+            each stage.
+        
+    Returns:
+        dict: The ATR, running_max, new_high, entry_signal, profit_target,
+            position, entry_price, returns and cumulative_returns arrays.
+    """
+    high = np.asarray(columns['high'], dtype=float)
+    close = np.asarray(columns['close'], dtype=float)
+    n = len(high)
+    
+    # Calculate ATR
+    with profile_stage(profiler, 'calculate_atr'):
+        atr = calculate_atr(high, columns['low'], close, period=atr_period).to_numpy()
+    
+    with profile_stage(profiler, 'entry_signals'):
+        # Calculate running maximum (all-time high)
+        running_max = np.fmax.accumulate(high)
+    
+        # Generate entry signals (a new high is a potential entry)
+        new_high = np.ones(n, dtype=bool)
+        new_high[1:] = running_max[1:] != running_max[:-1]
+        entry_signal = np.zeros(n, dtype=bool)
+        entry_signal[1:] = new_high[:-1]
+    
+    # Track active trades; the profit target is target_multiple * ATR above entry price
+    state = {'position': 0, 'target': np.nan, 'entry': np.nan,
+             'target_multiple': target_multiple, 'exits': exits}
+    with profile_stage(profiler, 'position_loop'):
+        position, profit_target, entry_price = _trend_following_positions(
+            columns['open'], high, atr, entry_signal, state, start=1)
+    
+    # Calculate returns
+    with profile_stage(profiler, 'returns'):
+        returns = np.zeros(n)
+        returns[1:] = np.where(position[:-1] == 1, close[1:] / close[:-1] - 1, 0)
+    
+    # The first bar has no previous new high to act on
+    entry_signal = entry_signal.astype(object)
+    entry_signal[:1] = np.nan
+    
+    return {'ATR': atr,
+            'running_max': running_max,
+            'new_high': new_high,
+            'entry_signal': entry_signal,
+            'profit_target': profit_target,
+            'position': position,
+            'entry_price': entry_price,
+            'returns': returns,
+            'cumulative_returns': np.cumprod(1 + returns)}
+
+def trend_following_strategy(df, atr_period=42, target_multiple=10, intrabar=None,
+                             profiler=None):
+    """
+    Implements a trend following strategy based on new all-time highs
+    with an ATR-based profit target.
+    
+    Args:
+        df (pd.DataFrame): The DataFrame with OHLCV data.
+        atr_period (int): The ATR calculation period.
+        target_multiple (float): The profit target as a multiple of ATR.
+        intrabar (callable): Optional fetch(day) of lower-timeframe bars,
+            e.g. from make_intrabar_fetcher in Version 1.2.py. When given,
+            exits are filled at the profit target, bars where the fill is
+            ambiguous on daily data are resolved from lower-timeframe bars,
+            and exit bar returns use the fill price (adds exit_price and
+            exit_time columns; needs a 'date' column).
+        profiler (dict): Optional profiler from new_profiler that times
+            each stage.
+        
+    Returns:
+        pd.DataFrame: The DataFrame with added strategy signals and metrics.
+    """
+    # Create copy of dataframe
+    with profile_stage(profiler, 'copy_frame'):
+        signals = df.copy()
+    
+    exits = [] if intrabar is not None else None
+    columns = trend_following_columns(signals, atr_period, target_multiple, exits, profiler)
+    with profile_stage(profiler, 'assign_columns'):
+        for name, values in columns.items():
+            signals[name] = values
+    
+    if intrabar is not None:
+        with profile_stage(profiler, 'intrabar_exits'):
+            _resolve_exits(signals, exits, intrabar)
+            signals['cumulative_returns'] = (1 + signals['returns']).cumprod()
+    
+    return signals
+
+def _resolve_exits(signals, exits, intrabar):
+    """
+    Fills profit target exits and reprices the exit bar returns in place.
+    
+    On daily bars a target hit on the entry day, or a bar that opens
+    through the target, does not tell when or at what price the target
+    filled. Only those bars are drilled into with the intrabar fetcher;
+    the first lower-timeframe bar reaching the target gives the fill time,
+    at the target or at that bar's open if it gapped through. Other exits
+    fill at the target.
+    
+    Args:
+        signals (pd.DataFrame): The strategy DataFrame, updated in place.
+        exits (list): The (bar, target, entered on the same bar) exits.
+        intrabar (callable): The intrabar fetcher, see trend_following_strategy.
+    """
+    exit_price = np.full(len(signals), np.nan)
+    exit_time = pd.Series(pd.NaT, index=signals.index, dtype='datetime64[ns]')
+    returns = signals['returns'].to_numpy(copy=True)
+    open_ = signals['open'].to_numpy(dtype=float)
+    close = signals['close'].to_numpy(dtype=float)
+    
+    for i, target, entered in exits:
+        price = target
+        if entered or open_[i] >= target:
+            bars = intrabar(signals['date'].iloc[i])
+            hit = bars[bars['high'] >= target]
+            if len(hit):
+                price = max(hit['open'].iloc[0], target)
+                exit_time.iloc[i] = hit['time'].iloc[0]
+            else:
+                price = max(open_[i], target)
+        exit_price[i] = price
+        # An entry-day exit is a round trip from the open
+        returns[i] = price / (open_[i] if entered else close[i - 1]) - 1
+    
+    signals['exit_price'] = exit_price
+    signals['exit_time'] = exit_time
+    signals['returns'] = returns
+
+def performance_metrics(results):
+    """
+    Calculates the performance metrics of a strategy run.
+    
+    Args:
+        results (pd.DataFrame): The output of trend_following_strategy.
+        
+    Returns:
+        dict: The total return, annualized return, maximum drawdown,
+            win rate and number of trades.
+    """
+    # Calculate metrics
+    total_returns = results['cumulative_returns'].iloc[-1] - 1
+    annual_returns = (1 + total_returns) ** (252 / len(results)) - 1
+    
+    # Calculate maximum drawdown
+    rolling_max = results['cumulative_returns'].expanding().max()
+    drawdowns = results['cumulative_returns'] / rolling_max - 1
+    max_drawdown = drawdowns.min()
+    
+    # Calculate win rate
+    trades = results[results['position'] != results['position'].shift(1)]
+    # A complete trade is an entry and an exit, so divide by 2
+    total_trades = len(trades) / 2  
+    wins = len(trades[trades['returns'] > 0])
+    if 'exit_price' in results:
+        # A target filled on its entry bar leaves the position flat, so
+        # those round trips are counted from the exit fills
+        round_trips = results[results['exit_price'].notna() & (results['position'].shift(1) != 1)]
+        total_trades += len(round_trips)
+        wins += len(round_trips[round_trips['returns'] > 0])
+    win_rate = wins / total_trades if total_trades > 0 else 0
+    
+    return {'total_returns': total_returns,
+            'annual_returns': annual_returns,
+            'max_drawdown': max_drawdown,
+            'win_rate': win_rate,
+            'total_trades': total_trades}
+
+def print_performance(metrics):
+    """
+    Prints the performance metrics returned by performance_metrics.
+    
+    Args:
+        metrics (dict): The performance metrics.
+    """
+    print(f"Total Return: {metrics['total_returns']:.2%}")
+    print(f"Annualized Return: {metrics['annual_returns']:.2%}")
+    print(f"Maximum Drawdown: {metrics['max_drawdown']:.2%}")
+    print(f"Win Rate: {metrics['win_rate']:.2%}")
+    print(f"Total Trades: {metrics['total_trades']:.0f}")
+
+def new_profiler():
+    """
+    Creates a profiler that records wall time, call counts and peak
+    allocations of every stage passed to profile_stage.
+    
+    Starts tracemalloc if it is not already tracing, which slows down
+    allocation-heavy stages, so compare wall times between profiled
+    runs only.
+        
+    Returns:
+        dict: The profiler state, for profile_stage and write_profile.
+    """
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    return {'stack': [], 'stats': {}, 'started_tracing': started_tracing}
+
+@contextlib.contextmanager
+def _record_stage(profiler, name):
+    """
+    Records one run of a stage, nested under the stage that is open.
+    """
+    stack = profiler['stack']
+    path = f"{stack[-1]['path']};{name}" if stack else name
+    current, peak = tracemalloc.get_traced_memory()
+    if stack:
+        stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+    tracemalloc.reset_peak()
+    frame = {'path': path, 'base': current, 'peak': current, 'children': 0.0,
+             'start': time.perf_counter()}
+    stack.append(frame)
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - frame['start']
+        stack.pop()
+        peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+        stats = profiler['stats'].setdefault(path, {'calls': 0, 'wall': 0.0, 'self': 0.0, 'peak': 0})
+        stats['calls'] += 1
+        stats['wall'] += wall
+        stats['self'] += wall - frame['children']
+        stats['peak'] = max(stats['peak'], peak - frame['base'])
+        if stack:
+            stack[-1]['children'] += wall
+            stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+
+def profile_stage(profiler, name):
+    """
+    Times a block of code as a named stage of a profiled backtest.
+    
+    Args:
+        profiler (dict): The profiler from new_profiler, or None to skip
+            recording.
+        name (str): The stage name.
+        
+    Returns:
+        A context manager; a no-op one when profiler is None.
+    """
+    if profiler is None:
+        return contextlib.nullcontext()
+    return _record_stage(profiler, name)
+
+def stop_profiler(profiler):
+    """
+    Stops tracemalloc if the profiler started it.
+    
+    Args:
+        profiler (dict): The profiler from new_profiler, or None.
+    """
+    if profiler is not None and profiler['started_tracing']:
+        tracemalloc.stop()
+        profiler['started_tracing'] = False
+
+def write_profile(profiler, path):
+    """
+    Writes the stage report and stops tracemalloc if the profiler started it.
+    
+    Creates <path>.csv with one row per stage (calls, total and self wall
+    time in seconds, peak allocation in bytes above the stage start) and
+    <path>.folded with the self time of every stage in microseconds as
+    collapsed stacks, for flamegraph.pl or speedscope.
+    
+    Args:
+        profiler (dict): The profiler from new_profiler.
+        path (str): The report path without extension.
+        
+    Returns:
+        pd.DataFrame: The report, slowest stage first.
+    """
+    stop_profiler(profiler)
+    
+    report = pd.DataFrame([{'stage': stage, 'calls': stats['calls'], 'wall_seconds': stats['wall'],
+                            'self_seconds': stats['self'], 'peak_bytes': stats['peak']}
+                           for stage, stats in profiler['stats'].items()],
+                          columns=['stage', 'calls', 'wall_seconds', 'self_seconds', 'peak_bytes'])
+    report = report.sort_values('wall_seconds', ascending=False, ignore_index=True)
+    report.to_csv(f"{path}.csv", index=False)
+    
+    with open(f"{path}.folded", 'w') as f:
+        for stage, stats in profiler['stats'].items():
+            f.write(f"{stage} {round(stats['self'] * 1e6)}\n")
+    
+    return report
+
+def backtest_strategy(df, atr_period=42, target_multiple=10, intrabar=None, profile=None):
+    """
+    Runs a backtest on the strategy and prints performance metrics.
+    
+    Args:
+        df (pd.DataFrame): The DataFrame with OHLCV data.
+        atr_period (int): The ATR calculation period.
+        target_multiple (float): The profit target as a multiple of ATR.
+        intrabar (callable): Optional intrabar fetcher for exact exit fills,
+            see trend_following_strategy.
+        profile (str): Optional report path without extension. When given,
+            every stage is timed and the report is printed and written
+            by write_profile.
+        
+    Returns:
+        pd.DataFrame: The DataFrame with backtest results.
+    """
+    profiler = new_profiler() if profile else None
+    
+    # Tracing is stopped even if the backtest fails
+    try:
+        with profile_stage(profiler, 'backtest_strategy'):
+            results = trend_following_strategy(df, atr_period, target_multiple, intrabar, profiler)
+        
+            with profile_stage(profiler, 'performance_metrics'):
+                metrics = performance_metrics(results)
+    finally:
+        stop_profiler(profiler)
+    
+    print_performance(metrics)
+    
+    if profiler is not None:
+        print(write_profile(profiler, profile).to_string(index=False))
+    
+    return results
+
+def iter_ohlcv_chunks(path, chunksize=1_000_000):
+    """
+    Reads OHLC bars from disk in chunks without loading the whole history.
+    
+    Supports CSV files, Parquet files (requires pyarrow) and .npy files
+    holding an MT5 rates record array, which are memory-mapped.
+    
+    Args:
+        path (str): The file to read.
+        chunksize (int): The number of bars per chunk.
+        
+    Yields:
+        pd.DataFrame: The next chunk with at least open, high, low and close columns.
+    """
+    if path.endswith('.csv'):
+        yield from pd.read_csv(path, chunksize=chunksize)
+    elif path.endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Reading Parquet files requires pyarrow (pip install pyarrow)")
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    elif path.endswith('.npy'):
+        bars = np.load(path, mmap_mode='r')
+        for start in range(0, len(bars), chunksize):
+            yield pd.DataFrame(bars[start:start + chunksize])
+    else:
+        raise ValueError(f"Unsupported file type: {path}")
+
+def trend_following_chunks(chunks, atr_period=42, target_multiple=10, profiler=None):
+    """
+    Runs the trend following strategy over a stream of chunks.
+    
+    The running maximum, the ATR window and the open trade are carried
+    across chunk boundaries, so the concatenated output matches
+    trend_following_strategy on the full history while only one chunk
+    is held in memory at a time.
+    
+    Args:
+        chunks (iterable): DataFrames with OHLC data, in chronological order.
+        atr_period (int): The ATR calculation period.
+        target_multiple (float): The profit target as a multiple of ATR.
+        profiler (dict): Optional profiler from new_profiler that times
+            each stage.
+        
+    Yields:
+        pd.DataFrame: The chunk with added strategy signals and metrics.
+    """
+    state = {'position': 0, 'target': np.nan, 'entry': np.nan,
+             'target_multiple': target_multiple}
+    tr_tail = np.empty(0)
+    last_close = np.nan
+    last_max = np.nan
+    last_new_high = None
+    last_position = np.nan
+    last_cumulative = 1.0
+    chunks = iter(chunks)
+    
+    while True:
+        # Reading is a stage of its own, as it often dominates on large files
+        with profile_stage(profiler, 'read_chunk'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        if len(chunk) == 0:
+            continue
+        with profile_stage(profiler, 'copy_frame'):
+            signals = chunk.copy()
+        high = signals['high'].to_numpy(dtype=float)
+        low = signals['low'].to_numpy(dtype=float)
+        close = signals['close'].to_numpy(dtype=float)
+        prev_close = np.concatenate(([last_close], close[:-1]))
+        first_chunk = last_new_high is None
+        
+        # Calculate ATR over the carried tail of true ranges plus this chunk
+        with profile_stage(profiler, 'calculate_atr'):
+            tr = np.fmax(high - low, np.fmax(np.abs(high - prev_close), np.abs(low - prev_close)))
+            tr_window = np.concatenate((tr_tail, tr))
+            atr = pd.Series(tr_window).rolling(window=atr_period).mean().to_numpy()[len(tr_tail):]
+            tr_tail = tr_window[-(atr_period - 1):] if atr_period > 1 else np.empty(0)
+            signals['ATR'] = atr
+        
+        with profile_stage(profiler, 'entry_signals'):
+            # Calculate running maximum (all-time high)
+            running_max = np.fmax.accumulate(np.concatenate(([last_max], high)))
+            signals['running_max'] = running_max[1:]
+            
+            # Generate entry signals (a new high is a potential entry)
+            new_high = running_max[1:] != running_max[:-1]
+            signals['new_high'] = new_high
+            if first_chunk:
+                signals['entry_signal'] = signals['new_high'].shift(1)
+            else:
+                signals['entry_signal'] = np.concatenate(([last_new_high], new_high[:-1]))
+            entry_signal = np.concatenate(([bool(last_new_high)], new_high[:-1]))
+        
+        with profile_stage(profiler, 'position_loop'):
+            position, profit_target, entry_price = _trend_following_positions(
+                signals['open'].to_numpy(), high, atr, entry_signal, state,
+                start=1 if first_chunk else 0)
+            signals['profit_target'] = profit_target
+            signals['position'] = position
+            signals['entry_price'] = entry_price
+        
+        with profile_stage(profiler, 'returns'):
+            # Calculate returns
+            prev_position = np.concatenate(([last_position], position[:-1]))
+            signals['returns'] = np.where(prev_position == 1, close / prev_close - 1, 0)
+            
+            # Calculate cumulative returns
+            cumulative = np.cumprod(np.concatenate(([last_cumulative], 1 + signals['returns'].to_numpy())))
+            signals['cumulative_returns'] = cumulative[1:]
+        
+        last_close = close[-1]
+        last_max = running_max[-1]
+        last_new_high = new_high[-1]
+        last_position = position[-1]
+        last_cumulative = cumulative[-1]
+        
+        yield signals
+
+def streaming_backtest(chunks, atr_period=42, target_multiple=10, profile=None):
+    """
+    Runs a backtest over a stream of chunks and prints performance metrics.
+    
+    Memory use depends on the chunk size, not on the length of the history.
+    
+    Args:
+        chunks (iterable): DataFrames with OHLC data, in chronological order,
+            e.g. from iter_ohlcv_chunks.
+        atr_period (int): The ATR calculation period.
+        target_multiple (float): The profit target as a multiple of ATR.
+        profile (str): Optional report path without extension, see
+            backtest_strategy.
+        
+    Returns:
+        dict: The performance metrics, as returned by performance_metrics.
+    """
+    profiler = new_profiler() if profile else None
+    bars = 0
+    peak = np.nan
+    max_drawdown = np.nan
+    cumulative = np.nan
+    last_position = np.nan
+    trade_rows = 0
+    wins = 0
+    
+    # Tracing is stopped even if the backtest fails
+    try:
+        with profile_stage(profiler, 'streaming_backtest'):
+            for signals in trend_following_chunks(chunks, atr_period, target_multiple, profiler):
+                with profile_stage(profiler, 'performance_metrics'):
+                    position = signals['position'].to_numpy()
+                    returns = signals['returns'].to_numpy()
+                    cumulative_returns = signals['cumulative_returns'].to_numpy()
+                    
+                    # Maximum drawdown against the running peak carried from earlier chunks
+                    rolling_max = np.fmax.accumulate(np.concatenate(([peak], cumulative_returns)))[1:]
+                    max_drawdown = np.fmin(max_drawdown, np.min(cumulative_returns / rolling_max - 1))
+                    
+                    # Rows where the position changes, as in performance_metrics
+                    changed = position != np.concatenate(([last_position], position[:-1]))
+                    trade_rows += int(changed.sum())
+                    wins += int((changed & (returns > 0)).sum())
+                
+                bars += len(signals)
+                peak = rolling_max[-1]
+                cumulative = cumulative_returns[-1]
+                last_position = position[-1]
+    finally:
+        stop_profiler(profiler)
+    
+    if bars == 0:
+        raise ValueError("streaming_backtest needs at least one bar, the chunks were empty")
+    
+    total_returns = cumulative - 1
+    total_trades = trade_rows / 2
+    metrics = {'total_returns': total_returns,
+               'annual_returns': (1 + total_returns) ** (252 / bars) - 1,
+               'max_drawdown': max_drawdown,
+               'win_rate': wins / total_trades if total_trades > 0 else 0,
+               'total_trades': total_trades}
+    
+    print_performance(metrics)
+    
+    if profiler is not None:
+        print(write_profile(profiler, profile).to_string(index=False))
+    
+    return metrics
+
+def _strategy_returns(close, position):
+    """
+    Calculates bar returns and cumulative returns for a position series.
+    
+    Args:
+        close (np.ndarray): The close prices.
+        position (np.ndarray): The position held at the end of each bar (1, 0 or -1).
+        
+    Returns:
+        tuple: The returns and cumulative returns arrays.
+    """
+    returns = np.zeros(len(close))
+    returns[1:] = position[:-1] * (close[1:] / close[:-1] - 1)
+    return returns, np.cumprod(1 + returns)
+
+def _band_positions(close, sma, std, num_std):
+    """
+    Calculates mean reversion positions from Bollinger-style bands.
+    
+    Goes long below the lower band and short above the upper band, and
+    goes flat once the price crosses back over the SMA.
+    
+    Args:
+        close (np.ndarray): The close prices.
+        sma (np.ndarray): The rolling mean of the close prices.
+        std (np.ndarray): The rolling standard deviation of the close prices.
+        num_std (float): The band width in standard deviations.
+        
+    Returns:
+        np.ndarray: The position at the end of each bar.
+    """
+    upper_band = sma + num_std * std
+    lower_band = sma - num_std * std
+    side = np.sign(close - sma)
+    crossed = np.ones(len(close), dtype=bool)
+    crossed[1:] = side[1:] != side[:-1]
+    events = np.where(close < lower_band, 1.0,
+                      np.where(close > upper_band, -1.0,
+                               np.where(crossed, 0.0, np.nan)))
+    return pd.Series(events).ffill().fillna(0).to_numpy()
+
+def _crossover_positions(close, short_sma, long_sma):
+    """
+    Calculates trend positions from a short/long SMA crossover.
+    
+    Long when the short SMA is above the long SMA and the price is above
+    the short SMA, short in the mirrored case, flat otherwise.
+    
+    Args:
+        close (np.ndarray): The close prices.
+        short_sma (np.ndarray): The short-window SMA.
+        long_sma (np.ndarray): The long-window SMA.
+        
+    Returns:
+        np.ndarray: The position at the end of each bar.
+    """
+    return np.where((short_sma > long_sma) & (close > short_sma), 1.0,
+                    np.where((short_sma < long_sma) & (close < short_sma), -1.0, 0.0))
+
+def band_strategy(df, window=20, num_std=2):
+    """
+    Implements the mean reversion strategy on Bollinger-style bands.
+    
+    Args:
+        df (pd.DataFrame): The DataFrame with OHLCV data.
+        window (int): The SMA and standard deviation window.
+        num_std (float): The band width in standard deviations.
+        
+    Returns:
+        pd.DataFrame: The DataFrame with added strategy signals and metrics.
+    """
+    signals = df.copy()
+    signals['SMA'] = signals['close'].rolling(window=window).mean()
+    signals['StdDev'] = signals['close'].rolling(window=window).std()
+    signals['UpperBand'] = signals['SMA'] + num_std * signals['StdDev']
+    signals['LowerBand'] = signals['SMA'] - num_std * signals['StdDev']
+    
+    close = signals['close'].to_numpy(dtype=float)
+    signals['position'] = _band_positions(close,
+                                          signals['SMA'].to_numpy(),
+                                          signals['StdDev'].to_numpy(),
+                                          num_std)
+    signals['returns'], signals['cumulative_returns'] = _strategy_returns(
+        close, signals['position'].to_numpy())
+    
+    return signals
+
+def crossover_strategy(df, short_window=42, long_window=126):
+    """
+    Implements the SMA crossover trend following strategy.
+    
+    Args:
+        df (pd.DataFrame): The DataFrame with OHLCV data.
+        short_window (int): The short SMA window.
+        long_window (int): The long SMA window.
+        
+    Returns:
+        pd.DataFrame: The DataFrame with added strategy signals and metrics.
+    """
+    signals = df.copy()
+    signals['ShortSMA'] = signals['close'].rolling(window=short_window).mean()
+    signals['LongSMA'] = signals['close'].rolling(window=long_window).mean()
+    
+    close = signals['close'].to_numpy(dtype=float)
+    signals['position'] = _crossover_positions(close,
+                                               signals['ShortSMA'].to_numpy(),
+                                               signals['LongSMA'].to_numpy())
+    signals['returns'], signals['cumulative_returns'] = _strategy_returns(
+        close, signals['position'].to_numpy())
+    
+    return signals
+
+def regime_strategy(df, regime_window=126, window=20, num_std=2, short_window=42, long_window=126):
+    """
+    Trades the band mean reversion rules while the market is mean reverting
+    and the SMA crossover rules while it is trending.
+    
+    Args:
+        df (pd.DataFrame): The DataFrame with OHLCV data.
+        regime_window (int): The Hurst / variance ratio window of detect_regime.
+        window (int): The band SMA and standard deviation window.
+        num_std (float): The band width in standard deviations.
+        short_window (int): The short SMA window.
+        long_window (int): The long SMA window.
+        
+    Returns:
+        pd.DataFrame: The DataFrame with added strategy signals and metrics.
+    """
+    band = band_strategy(df, window, num_std)
+    crossover = crossover_strategy(df, short_window, long_window)
+    
+    signals = band.drop(columns=['position', 'returns', 'cumulative_returns'])
+    signals['ShortSMA'] = crossover['ShortSMA']
+    signals['LongSMA'] = crossover['LongSMA']
+    signals['Regime'] = detect_regime(signals['close'].to_numpy(dtype=float), regime_window)
+    signals['position'] = route_positions(signals['Regime'].to_numpy(),
+                                          crossover['position'].to_numpy(),
+                                          band['position'].to_numpy())
+    signals['returns'], signals['cumulative_returns'] = _strategy_returns(
+        signals['close'].to_numpy(dtype=float), signals['position'].to_numpy())
+    
+    return signals
+
+def sma_matrix(close, windows):
+    """
+    Calculates simple moving averages for many windows from one cumulative sum.
+    
+    Prices are taken relative to the first close before summing, which
+    keeps the cumulative sum small and the window sums accurate.
+    
+    Args:
+        close (array-like): The close prices.
+        windows (array-like): The SMA windows.
+        
+    Returns:
+        np.ndarray: A (len(windows), len(close)) matrix with NaN before each
+            window is full, like pandas rolling.
+    """
+    close = np.asarray(close, dtype=float)
+    windows = np.asarray(windows, dtype=np.int64)
+    n = len(close)
+    if n == 0:
+        return np.empty((len(windows), 0))
+    
+    cumulative = np.concatenate(([0.0], np.cumsum(close - close[0])))
+    stops = np.arange(1, n + 1)
+    starts = stops[None, :] - windows[:, None]
+    sums = cumulative[stops][None, :] - cumulative[np.maximum(starts, 0)]
+    sma = sums / windows[:, None] + close[0]
+    sma[starts < 0] = np.nan
+    return sma
+
+def evaluate_crossover_grid(df, short_windows, long_windows, batch_size=64):
+    """
+    Backtests the SMA crossover strategy for every (short, long) window pair.
+    
+    The SMAs of all windows come from one cumulative-sum pass; positions,
+    returns and metrics are then computed for a batch of pairs at a time
+    as 2-D array operations. Results match crossover_strategy followed by
+    performance_metrics up to the rounding of the SMAs.
+    
+    Args:
+        df (pd.DataFrame): The DataFrame with OHLCV data.
+        short_windows (iterable): The candidate short windows.
+        long_windows (iterable): The candidate long windows.
+        batch_size (int): The number of pairs evaluated together; bounds memory.
+        
+    Returns:
+        pd.DataFrame: One row per pair with short < long, with the
+            performance_metrics columns.
+    """
+    close = df['close'].to_numpy(dtype=float)
+    n = len(close)
+    pairs = np.array([(short, long) for short in short_windows for long in long_windows
+                      if short < long], dtype=np.int64).reshape(-1, 2)
+    windows, index = np.unique(pairs, return_inverse=True)
+    index = index.reshape(-1, 2)
+    sma = sma_matrix(close, windows)
+    
+    bar_returns = np.zeros(n)
+    bar_returns[1:] = close[1:] / close[:-1] - 1
+    
+    metrics = []
+    for start in range(0, len(pairs), batch_size):
+        short_sma = sma[index[start:start + batch_size, 0]]
+        long_sma = sma[index[start:start + batch_size, 1]]
+        
+        position = (((short_sma > long_sma) & (close > short_sma)).view(np.int8)
+                    - ((short_sma < long_sma) & (close < short_sma)).view(np.int8))
+        returns = np.zeros(position.shape)
+        np.multiply(position[:, :-1], bar_returns[1:], out=returns[:, 1:])
+        cumulative_returns = np.cumprod(1 + returns, axis=1)
+        
+        total_returns = cumulative_returns[:, -1] - 1
+        drawdowns = cumulative_returns / np.maximum.accumulate(cumulative_returns, axis=1) - 1
+        
+        # Position changes, counting the first bar as performance_metrics does
+        changed = np.ones(position.shape, dtype=bool)
+        changed[:, 1:] = position[:, 1:] != position[:, :-1]
+        total_trades = changed.sum(axis=1) / 2
+        wins = (changed & (returns > 0)).sum(axis=1)
+        
+        metrics.append(pd.DataFrame({
+            'total_returns': total_returns,
+            'annual_returns': (1 + total_returns) ** (252 / n) - 1,
+            'max_drawdown': drawdowns.min(axis=1),
+            'win_rate': np.where(total_trades > 0, wins / np.maximum(total_trades, 1e-300), 0),
+            'total_trades': total_trades}))
+    
+    results = pd.concat(metrics, ignore_index=True) if metrics else pd.DataFrame(
+        columns=['total_returns', 'annual_returns', 'max_drawdown', 'win_rate', 'total_trades'])
+    results.insert(0, 'short_window', pairs[:, 0])
+    results.insert(1, 'long_window', pairs[:, 1])
+    return results
+
+def _make_evaluator(df, strategy):
+    """
+    Builds a function that backtests one parameter set on the last bars of df.
+    
+    Indicators are computed once over the full history and cached, so every
+    trial only slices the cached arrays and runs the position logic.
+    
+    Args:
+        df (pd.DataFrame): The DataFrame with OHLCV data.
+        strategy (str): 'trend_following', 'band', 'crossover' or 'regime'.
+        
+    Returns:
+        callable: evaluate(params, start) returning a results DataFrame with
+            position, returns and cumulative_returns columns.
+    """
+    close_series = df['close'].astype(float).reset_index(drop=True)
+    close = close_series.to_numpy()
+    cache = {}
+    
+    def cached(key, compute):
+        if key not in cache:
+            cache[key] = np.asarray(compute(), dtype=float)
+        return cache[key]
+    
+    def sma(window):
+        return cached(('sma', window), lambda: close_series.rolling(window=window).mean())
+    
+    def std(window):
+        return cached(('std', window), lambda: close_series.rolling(window=window).std())
+    
+    if strategy == 'trend_following':
+        open_ = df['open'].to_numpy(dtype=float)
+        high = df['high'].to_numpy(dtype=float)
+        running_max = pd.Series(high).expanding().max()
+        entry_signal = (running_max != running_max.shift(1)).shift(1, fill_value=False).to_numpy()
+        
+        def positions(params, start):
+            atr = cached(('atr', params['atr_period']),
+                         lambda: calculate_atr(df['high'].to_numpy(), df['low'].to_numpy(),
+                                               df['close'].to_numpy(), period=params['atr_period']))
+            state = {'position': 0, 'target': np.nan, 'entry': np.nan,
+                     'target_multiple': params['target_multiple']}
+            return _trend_following_positions(open_[start:], high[start:], atr[start:],
+                                              entry_signal[start:], state, start=1)[0]
+    elif strategy == 'band':
+        def positions(params, start):
+            window = params['window']
+            return _band_positions(close[start:], sma(window)[start:], std(window)[start:],
+                                   params['num_std'])
+    elif strategy == 'crossover':
+        def positions(params, start):
+            return _crossover_positions(close[start:],
+                                        sma(params['short_window'])[start:],
+                                        sma(params['long_window'])[start:])
+    elif strategy == 'regime':
+        def positions(params, start):
+            window = params.get('window', 20)
+            regime = cached(('regime', params.get('regime_window', 126)),
+                            lambda: detect_regime(close, params.get('regime_window', 126)))
+            return route_positions(regime[start:],
+                                   _crossover_positions(close[start:],
+                                                        sma(params.get('short_window', 42))[start:],
+                                                        sma(params.get('long_window', 126))[start:]),
+                                   _band_positions(close[start:], sma(window)[start:], std(window)[start:],
+                                                   params.get('num_std', 2)))
+    else:
+        raise ValueError(f"Unknown strategy: {strategy}")
+    
+    def evaluate(params, start=0):
+        position = positions(params, start)
+        returns, cumulative_returns = _strategy_returns(close[start:], position)
+        return pd.DataFrame({'position': position,
+                             'returns': returns,
+                             'cumulative_returns': cumulative_returns})
+    
+    return evaluate
+
+def optimize_strategy(df, strategy, param_grid, min_bars=252, eta=3, score='total_returns'):
+    """
+    Searches strategy parameters with successive halving.
+    
+    Every parameter set is first backtested on the most recent bars only;
+    the best 1/eta of them are promoted to eta times more history, until
+    the survivors are run on the full history. Indicator arrays are cached
+    and shared between all trials.
+    
+    Args:
+        df (pd.DataFrame): The DataFrame with OHLCV data.
+        strategy (str): 'trend_following' (atr_period, target_multiple),
+            'band' (window, num_std), 'crossover' (short_window, long_window)
+            or 'regime' (regime_window and the band and crossover parameters).
+        param_grid (dict): The candidate values for each parameter.
+        min_bars (int): The history length of the first rung.
+        eta (int): The promotion factor between rungs.
+        score (str or callable): A performance_metrics key, or a function of
+            the metrics dict; higher is better.
+        
+    Returns:
+        pd.DataFrame: One row per trial with the parameters, the number of
+            bars used and the score, best full-history result first.
+    """
+    evaluate = _make_evaluator(df, strategy)
+    configs = [dict(zip(param_grid.keys(), values))
+               for values in itertools.product(*param_grid.values())]
+    n = len(df)
+    
+    # Size every rung from the full history, n / eta ** rungs bars first and n
+    # last, rounded up so rounding never leaves a rung just short of n
+    rungs = int(np.ceil(np.log(len(configs)) / np.log(eta))) if len(configs) > 1 else 0
+    rung = 0
+    bars = min(n, max(min_bars, -(-n // eta ** rungs)))
+    
+    trials = []
+    while True:
+        scores = []
+        for config in configs:
+            metrics = performance_metrics(evaluate(config, n - bars))
+            value = score(metrics) if callable(score) else metrics[score]
+            scores.append(value)
+            trials.append({**config, 'bars': bars, 'score': value})
+        if bars >= n:
+            break
+        
+        # Promote the best 1/eta of the configurations to more history
+        keep = max(1, int(np.ceil(len(configs) / eta)))
+        order = np.argsort(-np.nan_to_num(np.asarray(scores, dtype=float), nan=-np.inf),
+                           kind='stable')
+        configs = [configs[i] for i in order[:keep]]
+        rung += 1
+        bars = min(n, max(min_bars * eta ** rung, -(-n // eta ** (rungs - rung))))
+    
+    return (pd.DataFrame(trials)
+            .sort_values(['bars', 'score'], ascending=False, na_position='last')
+            .reset_index(drop=True))
+
+def build_sparse_table(values, mode='max'):
+    """
+    Builds a sparse table for O(1) range maximum or minimum queries.
+    
+    Row k holds the extreme of every window of 2**k values starting at
+    each position, so the table takes O(n log n) memory and is built once
+    per series.
+    
+    Args:
+        values (array-like): The series to index (e.g. high or low prices).
+        mode (str): 'max' or 'min'.
+        
+    Returns:
+        np.ndarray: The (levels, n) table; positions past the end of the
+            series are NaN.
+    """
+    reduce = np.fmax if mode == 'max' else np.fmin
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    levels = max(1, int(np.log2(n)) + 1) if n else 1
+    table = np.full((levels, n), np.nan)
+    table[0] = values
+    for k in range(1, levels):
+        half = 1 << (k - 1)
+        width = n - (1 << k) + 1
+        table[k, :width] = reduce(table[k - 1, :width], table[k - 1, half:half + width])
+    return table
+
+def query_range_extreme(table, starts, stops, mode='max'):
+    """
+    Queries the extreme of values[start:stop] for many ranges at once.
+    
+    Args:
+        table (np.ndarray): The table from build_sparse_table.
+        starts (array-like): The first position of each range.
+        stops (array-like): One past the last position of each range.
+        mode (str): 'max' or 'min', matching the table.
+        
+    Returns:
+        np.ndarray: The extreme of each range; NaN for empty ranges.
+    """
+    reduce = np.fmax if mode == 'max' else np.fmin
+    starts = np.asarray(starts, dtype=np.int64)
+    stops = np.asarray(stops, dtype=np.int64)
+    lengths = stops - starts
+    valid = lengths > 0
+    k = np.zeros(len(lengths), dtype=np.int64)
+    k[valid] = np.log2(lengths[valid]).astype(np.int64)
+    left = np.where(valid, starts, 0)
+    right = np.where(valid, stops - (1 << k), 0)
+    result = reduce(table[k, left], table[k, right])
+    return np.where(valid, result, np.nan)
+
+def rolling_extreme(values, window, mode='max'):
+    """
+    Calculates a rolling maximum or minimum with a monotonic deque.
+    
+    Each value enters and leaves the deque once, so the cost is O(n)
+    regardless of the window length. The first window - 1 values are NaN,
+    as with pandas rolling.
+    
+    Args:
+        values (array-like): The series to scan.
+        window (int): The window length.
+        mode (str): 'max' or 'min'.
+        
+    Returns:
+        np.ndarray: The rolling extreme.
+    """
+    values = np.asarray(values, dtype=float).tolist()
+    result = np.full(len(values), np.nan)
+    candidates = deque()
+    for i, value in enumerate(values):
+        if mode == 'max':
+            while candidates and values[candidates[-1]] <= value:
+                candidates.pop()
+        else:
+            while candidates and values[candidates[-1]] >= value:
+                candidates.pop()
+        candidates.append(i)
+        if candidates[0] <= i - window:
+            candidates.popleft()
+        if i >= window - 1:
+            result[i] = values[candidates[0]]
+    return result
+
+def donchian_breakouts(df, lookbacks):
+    """
+    Flags N-bar breakouts for many lookbacks from one sparse table per side.
+    
+    A bar breaks out upwards when its high exceeds the highest high of the
+    previous N bars, and downwards when its low is below the lowest low of
+    the previous N bars.
+    
+    Args:
+        df (pd.DataFrame): The DataFrame with OHLCV data.
+        lookbacks (iterable): The channel lengths N.
+        
+    Returns:
+        pd.DataFrame: Boolean 'breakout_up_N' and 'breakout_down_N' columns.
+    """
+    high = df['high'].to_numpy(dtype=float)
+    low = df['low'].to_numpy(dtype=float)
+    high_table = build_sparse_table(high, 'max')
+    low_table = build_sparse_table(low, 'min')
+    
+    n = len(df)
+    stops = np.arange(n)
+    breakouts = {}
+    for lookback in lookbacks:
+        starts = stops - lookback
+        # Bars without a full channel behind them never break out
+        starts[starts < 0] = stops[starts < 0]
+        upper = query_range_extreme(high_table, starts, stops, 'max')
+        lower = query_range_extreme(low_table, starts, stops, 'min')
+        breakouts[f'breakout_up_{lookback}'] = high > upper
+        breakouts[f'breakout_down_{lookback}'] = low < lower
+    
+    return pd.DataFrame(breakouts, index=df.index)
+
+def _strategy_code(strategy):
+    """
+    Returns the functions whose source determines a strategy's results.
+    
+    Args:
+        strategy (str): 'trend_following', 'band', 'crossover' or 'regime'.
+        
+    Returns:
+        tuple: The strategy function and the list of functions (or modules)
+            it depends on.
+    """
+    strategies = {
+        'trend_following': (trend_following_strategy,
+                            [trend_following_columns, _trend_following_positions, calculate_atr]),
+        'band': (band_strategy, [_band_positions, _strategy_returns]),
+        'crossover': (crossover_strategy, [_crossover_positions, _strategy_returns]),
+        'regime': (regime_strategy, [band_strategy, crossover_strategy, _band_positions,
+                                     _crossover_positions, _strategy_returns,
+                                     inspect.getmodule(detect_regime)]),
+    }
+    if strategy not in strategies:
+        raise ValueError(f"Unknown strategy: {strategy}")
+    function, dependencies = strategies[strategy]
+    return function, [function, performance_metrics] + dependencies
+
+def backtest_cache_key(df, strategy, params):
+    """
+    Hashes the input data, parameters and strategy code of a backtest.
+    
+    Args:
+        df (pd.DataFrame): The DataFrame with OHLCV data.
+        strategy (str): 'trend_following', 'band', 'crossover' or 'regime'.
+        params (dict): The strategy parameters.
+        
+    Returns:
+        str: The hex digest identifying the backtest result.
+    """
+    _, code = _strategy_code(strategy)
+    digest = hashlib.sha256()
+    digest.update(json.dumps([strategy, sorted(params.items()), list(map(str, df.columns))],
+                             default=str).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    for function in code:
+        digest.update(inspect.getsource(function).encode())
+    return digest.hexdigest()
+
+def cached_backtest(df, strategy='trend_following', params=None,
+                    cache_dir='.backtest_cache', max_bytes=256 * 1024 ** 2):
+    """
+    Runs a backtest, or loads its result if the same data, parameters and
+    strategy code were backtested before.
+    
+    Results are stored as compressed .npz files named by backtest_cache_key.
+    Loading a result marks it as recently used; once the cache grows past
+    max_bytes the least recently used results are deleted.
+    
+    Args:
+        df (pd.DataFrame): The DataFrame with OHLCV data.
+        strategy (str): 'trend_following', 'band', 'crossover' or 'regime'.
+        params (dict): The strategy parameters (defaults if omitted).
+        cache_dir (str): The cache directory.
+        max_bytes (int): The maximum total size of the cache.
+        
+    Returns:
+        tuple: The performance_metrics dict and a DataFrame with the position
+            and cumulative_returns columns, indexed like df.
+    """
+    params = params or {}
+    path = os.path.join(cache_dir, backtest_cache_key(df, strategy, params) + '.npz')
+    
+    if os.path.exists(path):
+        with np.load(path) as stored:
+            metrics = json.loads(str(stored['metrics']))
+            position = stored['position']
+            if 'position_dtype' in stored.files:
+                position = position.astype(str(stored['position_dtype']))
+            curve = pd.DataFrame({'position': position,
+                                  'cumulative_returns': stored['cumulative_returns']},
+                                 index=df.index)
+        os.utime(path)
+        return metrics, curve
+    
+    function, _ = _strategy_code(strategy)
+    results = function(df, **params)
+    metrics = {name: float(value) for name, value in performance_metrics(results).items()}
+    curve = results[['position', 'cumulative_returns']]
+    
+    # Positions are stored as int8 when that is exact, with their dtype so a
+    # hit returns the same columns as a miss
+    position = curve['position'].to_numpy()
+    compact = position.astype(np.int8)
+    if not np.array_equal(compact, position):
+        compact = position
+    
+    os.makedirs(cache_dir, exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez_compressed(temporary,
+                        position=compact,
+                        position_dtype=np.array(position.dtype.str),
+                        cumulative_returns=curve['cumulative_returns'].to_numpy(dtype=float),
+                        metrics=np.array(json.dumps(metrics)))
+    os.replace(temporary, path)
+    _evict_backtest_cache(cache_dir, max_bytes)
+    
+    return metrics, curve
+
+def _evict_backtest_cache(cache_dir, max_bytes):
+    """
+    Deletes the least recently used results until the cache fits in max_bytes.
+    
+    Args:
+        cache_dir (str): The cache directory.
+        max_bytes (int): The maximum total size of the cache.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.npz') and '.tmp' not in entry.name:
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def new_pair_state(window=60):
+    """
+    Creates the rolling statistics of one pair for update_pair_state.
+    
+    Args:
+        window (int): The number of bars in the rolling regression.
+        
+    Returns:
+        dict: The empty state.
+    """
+    return {'window': window, 'bars': deque(), 'origin': None,
+            'sum_x': 0.0, 'sum_y': 0.0, 'sum_xx': 0.0, 'sum_yy': 0.0, 'sum_xy': 0.0}
+
+def update_pair_state(state, y, x):
+    """
+    Adds one bar of a pair and returns its hedge ratio and spread z-score.
+    
+    Keeps running sums of the prices, their squares and their product over
+    the window, so each bar costs the same however long the window is.
+    The spread variance follows from them as
+    var(y) - 2 * beta * cov(x, y) + beta ** 2 * var(x).
+    
+    Args:
+        state (dict): The state from new_pair_state, updated in place.
+        y (float): The price of the dependent symbol.
+        x (float): The price of the hedge symbol.
+        
+    Returns:
+        tuple: The hedge ratio, spread (y - hedge ratio * x) and spread
+            z-score, all NaN until the window is full.
+    """
+    # Sums of deviations from the first bar instead of raw prices avoid
+    # cancellation in the variances
+    if state['origin'] is None:
+        state['origin'] = (y, x)
+    dy = y - state['origin'][0]
+    dx = x - state['origin'][1]
+    
+    bars = state['bars']
+    bars.append((dy, dx))
+    state['sum_y'] += dy
+    state['sum_x'] += dx
+    state['sum_yy'] += dy * dy
+    state['sum_xx'] += dx * dx
+    state['sum_xy'] += dx * dy
+    if len(bars) > state['window']:
+        old_y, old_x = bars.popleft()
+        state['sum_y'] -= old_y
+        state['sum_x'] -= old_x
+        state['sum_yy'] -= old_y * old_y
+        state['sum_xx'] -= old_x * old_x
+        state['sum_xy'] -= old_x * old_y
+    
+    n = len(bars)
+    if n < state['window']:
+        return np.nan, np.nan, np.nan
+    mean_y = state['sum_y'] / n
+    mean_x = state['sum_x'] / n
+    var_y = state['sum_yy'] / n - mean_y * mean_y
+    var_x = state['sum_xx'] / n - mean_x * mean_x
+    cov = state['sum_xy'] / n - mean_x * mean_y
+    if var_x <= 0:
+        return np.nan, np.nan, np.nan
+    
+    beta = cov / var_x
+    spread_var = var_y - 2 * beta * cov + beta * beta * var_x
+    zscore = (dy - beta * dx - (mean_y - beta * mean_x)) / np.sqrt(spread_var) if spread_var > 0 else np.nan
+    
+    return beta, y - beta * x, zscore
+
+def _pair_positions(zscore, entry_z, exit_z):
+    """
+    Calculates spread positions from the spread z-score.
+    
+    Buys the spread (long y, short x) below -entry_z, sells it above
+    entry_z, and goes flat once the z-score is back within exit_z.
+    
+    Args:
+        zscore (np.ndarray): The spread z-score.
+        entry_z (float): The z-score that opens a position.
+        exit_z (float): The z-score that closes it.
+        
+    Returns:
+        np.ndarray: The spread position at the end of each bar.
+    """
+    events = np.where(zscore < -entry_z, 1.0,
+                      np.where(zscore > entry_z, -1.0,
+                               np.where(np.abs(zscore) < exit_z, 0.0, np.nan)))
+    return pd.Series(events).ffill().fillna(0).to_numpy()
+
+def pairs_strategy(df_y, df_x, window=60, entry_z=2.0, exit_z=0.5):
+    """
+    Implements the spread mean reversion strategy on a pair of symbols.
+    
+    The hedge ratio and z-score of every bar only use bars up to that bar,
+    as update_pair_state computes them live.
+    
+    Args:
+        df_y (pd.DataFrame): The OHLCV data of the dependent symbol.
+        df_x (pd.DataFrame): The OHLCV data of the hedge symbol; rows are
+            matched on the 'date' column when both have one.
+        window (int): The rolling regression window.
+        entry_z (float): The z-score that opens a position.
+        exit_z (float): The z-score that closes it.
+        
+    Returns:
+        pd.DataFrame: The closes of both symbols with the hedge_ratio,
+            spread, zscore, position, returns and cumulative_returns columns.
+    """
+    if 'date' in df_y and 'date' in df_x:
+        signals = pd.merge(df_y[['date', 'close']], df_x[['date', 'close']],
+                           on='date', suffixes=('_y', '_x'))
+    else:
+        signals = pd.DataFrame({'close_y': df_y['close'].to_numpy(),
+                                'close_x': df_x['close'].to_numpy()})
+    close_y = signals['close_y'].to_numpy(dtype=float)
+    close_x = signals['close_x'].to_numpy(dtype=float)
+    
+    state = new_pair_state(window)
+    stats = np.array([update_pair_state(state, y, x) for y, x in zip(close_y.tolist(), close_x.tolist())])
+    signals['hedge_ratio'] = stats[:, 0]
+    signals['spread'] = stats[:, 1]
+    signals['zscore'] = stats[:, 2]
+    position = _pair_positions(stats[:, 2], entry_z, exit_z)
+    signals['position'] = position
+    
+    # Profit of one unit of y against hedge ratio units of x, per unit of gross exposure
+    beta = stats[:, 0]
+    returns = np.zeros(len(signals))
+    held = position[:-1] != 0
+    pnl = np.diff(close_y) - beta[:-1] * np.diff(close_x)
+    exposure = np.abs(close_y[:-1]) + np.abs(beta[:-1] * close_x[:-1])
+    returns[1:][held] = position[:-1][held] * pnl[held] / exposure[held]
+    signals['returns'] = returns
+    signals['cumulative_returns'] = np.cumprod(1 + returns)
+    
+    return signals
+
+def scan_pairs(prices, batch_size=256, max_t_stat=-3.37, min_correlation=0.5):
+    """
+    Scans every pair of a universe for cointegration candidates.
+    
+    Each pair is regressed (y on x) over the whole history and an
+    Engle-Granger style Dickey-Fuller t-statistic is computed on the
+    residual spread. Pairs are processed batch_size at a time as
+    (bars, pairs) matrices, so there is no Python loop over pairs.
+    
+    Args:
+        prices (pd.DataFrame): One column of closes per symbol, rows aligned
+            in time.
+        batch_size (int): The number of pairs per batch.
+        max_t_stat (float): The largest Dickey-Fuller t-statistic kept
+            (about the 5% critical value for two symbols by default).
+        min_correlation (float): The smallest price correlation kept.
+        
+    Returns:
+        pd.DataFrame: One row per candidate (y, x, hedge_ratio, correlation,
+            t_stat, half_life in bars), most significant first.
+    """
+    prices = prices.dropna()
+    symbols = list(prices.columns)
+    values = prices.to_numpy(dtype=float)
+    values = values - values.mean(axis=0)
+    n = len(values)
+    
+    covariance = values.T @ values / n
+    std = np.sqrt(np.diag(covariance))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlation = covariance / np.outer(std, std)
+    x_index, y_index = np.triu_indices(len(symbols), 1)
+    keep = correlation[x_index, y_index] >= min_correlation
+    x_index, y_index = x_index[keep], y_index[keep]
+    
+    candidates = []
+    for start in range(0, len(x_index), batch_size):
+        xs = x_index[start:start + batch_size]
+        ys = y_index[start:start + batch_size]
+        beta = covariance[xs, ys] / covariance[xs, xs]
+        spread = values[:, ys] - beta * values[:, xs]
+        
+        # Regress the spread change on the lagged spread
+        change = np.diff(spread, axis=0)
+        lagged = spread[:-1] - spread[:-1].mean(axis=0)
+        lagged_ss = np.einsum('ij,ij->j', lagged, lagged)
+        gamma = np.einsum('ij,ij->j', change, lagged) / lagged_ss
+        residuals = change - change.mean(axis=0) - gamma * lagged
+        std_error = np.sqrt(np.einsum('ij,ij->j', residuals, residuals) / (n - 3) / lagged_ss)
+        t_stat = gamma / std_error
+        with np.errstate(divide='ignore', invalid='ignore'):
+            half_life = np.where(gamma <= -1, 0.0,
+                                 np.where(gamma < 0, -np.log(2) / np.log1p(gamma), np.inf))
+        
+        found = t_stat <= max_t_stat
+        candidates.append(pd.DataFrame({'y': np.array(symbols, dtype=object)[ys[found]],
+                                        'x': np.array(symbols, dtype=object)[xs[found]],
+                                        'hedge_ratio': beta[found],
+                                        'correlation': correlation[xs[found], ys[found]],
+                                        't_stat': t_stat[found],
+                                        'half_life': half_life[found]}))
+    
+    if not candidates:
+        return pd.DataFrame(columns=['y', 'x', 'hedge_ratio', 'correlation', 't_stat', 'half_life'])
+    return pd.concat(candidates, ignore_index=True).sort_values('t_stat', ignore_index=True)
+
+def sweep_job(symbol, strategy='trend_following', data_dir='.', cache_dir='.backtest_cache', **params):
+    """
+    Backtests one symbol and parameter set; the default job of sweep_cluster
+    workers ("backtest.py:sweep_job"), which need no MT5 terminal.
+    
+    Reads <data_dir>/<symbol>.csv, e.g. saved with get_mt5_data(symbol).to_csv
+    in Version 1.2.py,
+    and goes through cached_backtest, so a retried task is not recomputed.
+    
+    Args:
+        symbol (str): The symbol, which names the data file.
+        strategy (str): 'trend_following', 'band', 'crossover' or 'regime'.
+        data_dir (str): The directory holding the data files.
+        cache_dir (str): The backtest cache directory of this node.
+        **params: The strategy parameters.
+        
+    Returns:
+        dict: The performance metrics.
+    """
+    df = pd.read_csv(os.path.join(data_dir, f"{symbol}.csv"))
+    metrics, _ = cached_backtest(df, strategy, params, cache_dir=cache_dir)
+    return metrics
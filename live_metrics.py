@@ -0,0 +1,231 @@
+import math
+from collections import deque
+
+# Streaming performance tracking for live strategies. Fills and price ticks
+# update running equity, peak, drawdown and exposure in constant time, so any
+# number of strategy instances can be watched without recomputing anything
+# from their history. The rolling volatility/Sharpe window gets one return
+# per mark(), which the strategy loop calls once per period however many
+# symbols and fills the period had.
+
+class StrategyMetrics:
+    """
+    Running equity and risk metrics of one strategy instance.
+    """
+
+    def __init__(self, name, initial_capital=10000.0, window=252, periods_per_year=252):
+        """
+        Args:
+            name (str): The strategy instance name.
+            initial_capital (float): The starting equity.
+            window (int): The number of marks (period returns) in the
+                rolling volatility and Sharpe ratio.
+            periods_per_year (int): The marks per year, for annualization.
+        """
+        self.name = name
+        self.window = window
+        self.periods_per_year = periods_per_year
+        self.cash = initial_capital
+        self.positions = {}      # Signed quantity by symbol
+        self.prices = {}         # Last price by symbol
+        self.market_value = 0.0  # Sum of quantity * price
+        self.gross_exposure = 0.0  # Sum of |quantity * price|
+        self.equity = initial_capital
+        self.peak = initial_capital
+        self.max_drawdown = 0.0
+        self.fills = 0
+        self.marks = 0
+        self._marked_equity = initial_capital
+        self._returns = deque()
+        self._sum = 0.0
+        self._sum_squares = 0.0
+
+    def _revalue(self, symbol, quantity, price):
+        """
+        Replaces the contribution of one symbol to market value and exposure.
+        """
+        old_quantity = self.positions.get(symbol, 0.0)
+        old_price = self.prices.get(symbol, price)
+        self.market_value += quantity * price - old_quantity * old_price
+        self.gross_exposure += abs(quantity * price) - abs(old_quantity * old_price)
+        self.positions[symbol] = quantity
+        self.prices[symbol] = price
+
+    def on_fill(self, symbol, quantity, price, fee=0.0):
+        """
+        Records an executed order.
+
+        Args:
+            symbol (str): The traded symbol.
+            quantity (float): The signed fill quantity (negative for sells).
+            price (float): The fill price.
+            fee (float): Commission paid.
+        """
+        self.cash -= quantity * price + fee
+        self._revalue(symbol, self.positions.get(symbol, 0.0) + quantity, price)
+        self.fills += 1
+        self._update_equity()
+
+    def on_price(self, symbol, price):
+        """
+        Revalues a symbol at its latest price. No return is recorded until
+        the next mark().
+
+        Args:
+            symbol (str): The symbol.
+            price (float): The latest price.
+        """
+        self._revalue(symbol, self.positions.get(symbol, 0.0), price)
+        self._update_equity()
+
+    def _update_equity(self):
+        """
+        Updates equity, peak and drawdown.
+        """
+        self.equity = self.cash + self.market_value
+        self.peak = max(self.peak, self.equity)
+        if self.peak > 0:
+            self.max_drawdown = min(self.max_drawdown, self.equity / self.peak - 1)
+
+    def mark(self):
+        """
+        Ends a period: adds the equity return since the previous mark to the
+        rolling window. Call it once per period, e.g. once per loop cycle
+        after the prices were updated, so the window follows periods_per_year.
+        """
+        previous = self._marked_equity
+        self._marked_equity = self.equity
+        if previous == 0:
+            return
+
+        period_return = self.equity / previous - 1
+        self._returns.append(period_return)
+        self._sum += period_return
+        self._sum_squares += period_return * period_return
+        if len(self._returns) > self.window:
+            oldest = self._returns.popleft()
+            self._sum -= oldest
+            self._sum_squares -= oldest * oldest
+        self.marks += 1
+
+    def volatility(self):
+        """
+        Returns the annualized volatility of the rolling return window.
+
+        Returns:
+            float: The volatility, NaN with fewer than two returns.
+        """
+        n = len(self._returns)
+        if n < 2:
+            return math.nan
+        variance = max((self._sum_squares - self._sum * self._sum / n) / (n - 1), 0.0)
+        return math.sqrt(variance * self.periods_per_year)
+
+    def sharpe(self):
+        """
+        Returns the annualized Sharpe ratio of the rolling return window
+        (zero risk-free rate).
+
+        Returns:
+            float: The Sharpe ratio, NaN when volatility is zero or unknown.
+        """
+        volatility = self.volatility()
+        if not volatility or math.isnan(volatility):
+            return math.nan
+        return (self._sum / len(self._returns)) * self.periods_per_year / volatility
+
+    def snapshot(self):
+        """
+        Returns the current metrics.
+
+        Returns:
+            dict: Equity, peak, drawdown, max drawdown, volatility, Sharpe
+                ratio, net and gross exposure and positions.
+        """
+        return {'name': self.name,
+                'equity': self.equity,
+                'peak': self.peak,
+                'drawdown': self.equity / self.peak - 1 if self.peak > 0 else math.nan,
+                'max_drawdown': self.max_drawdown,
+                'volatility': self.volatility(),
+                'sharpe': self.sharpe(),
+                'net_exposure': self.market_value,
+                'gross_exposure': self.gross_exposure,
+                'positions': {s: q for s, q in self.positions.items() if q},
+                'fills': self.fills}
+
+class MetricsBook:
+    """
+    The metrics of many strategy instances, with ticks routed only to the
+    instances holding the symbol.
+    """
+
+    def __init__(self, **defaults):
+        """
+        Args:
+            **defaults: StrategyMetrics arguments for new instances.
+        """
+        self.defaults = defaults
+        self.strategies = {}
+        self._holders = {}  # Strategy names by symbol
+
+    def strategy(self, name):
+        """
+        Returns the metrics of a strategy instance, creating it if needed.
+
+        Args:
+            name (str): The strategy instance name.
+
+        Returns:
+            StrategyMetrics: The instance metrics.
+        """
+        if name not in self.strategies:
+            self.strategies[name] = StrategyMetrics(name, **self.defaults)
+        return self.strategies[name]
+
+    def on_fill(self, name, symbol, quantity, price, fee=0.0):
+        """
+        Records an executed order of a strategy instance.
+
+        Args:
+            name (str): The strategy instance name.
+            symbol (str): The traded symbol.
+            quantity (float): The signed fill quantity (negative for sells).
+            price (float): The fill price.
+            fee (float): Commission paid.
+        """
+        metrics = self.strategy(name)
+        metrics.on_fill(symbol, quantity, price, fee)
+        holders = self._holders.setdefault(symbol, set())
+        if metrics.positions[symbol]:
+            holders.add(name)
+        else:
+            holders.discard(name)
+
+    def on_price(self, symbol, price):
+        """
+        Revalues a symbol in every instance holding it.
+
+        Args:
+            symbol (str): The symbol.
+            price (float): The latest price.
+        """
+        for name in self._holders.get(symbol, ()):
+            self.strategies[name].on_price(symbol, price)
+
+    def mark(self):
+        """
+        Ends a period for every instance, flat ones included, so each
+        records one return per period.
+        """
+        for metrics in self.strategies.values():
+            metrics.mark()
+
+    def snapshot(self):
+        """
+        Returns the current metrics of every instance.
+
+        Returns:
+            list: One snapshot dict per strategy instance.
+        """
+        return [metrics.snapshot() for metrics in self.strategies.values()]
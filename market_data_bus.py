@@ -0,0 +1,366 @@
+import re
+import sys
+import time
+import numpy as np
+from multiprocessing import shared_memory
+
+# One feed process publishes bars and ticks for each channel ("AAPL:1m",
+# "AAPL:1h", ...) into its own shared memory block; any number of strategy
+# processes attach to the same blocks and read without locks or copies.
+#
+# Block layout: a header record followed by a ring of 2 * capacity bars. Every
+# bar is written to slot i and slot i + capacity, so the latest n bars are
+# always one contiguous slice and can be handed out as a view.
+# The header's seq counter is a seqlock: odd while the feed is writing.
+# Readers retry with short sleeps and give up with TimeoutError if it stays
+# odd, e.g. because the feed process died in the middle of a write.
+
+HEADER_DTYPE = np.dtype([('seq', '<i8'), ('count', '<i8'), ('capacity', '<i8'),
+                         ('tick_time', '<i8'), ('bid', '<f8'), ('ask', '<f8')])
+BAR_DTYPE = np.dtype([('time', '<i8'), ('open', '<f8'), ('high', '<f8'),
+                      ('low', '<f8'), ('close', '<f8'), ('volume', '<f8')])
+
+# yfinance period to download for each bar interval
+FEED_PERIODS = {'1m': '1d', '5m': '5d', '15m': '5d', '1h': '1mo', '1d': '1y'}
+
+# MT5 timeframe constant names for each bar interval
+MT5_TIMEFRAMES = {'1m': 'TIMEFRAME_M1', '5m': 'TIMEFRAME_M5', '15m': 'TIMEFRAME_M15',
+                  '1h': 'TIMEFRAME_H1', '1d': 'TIMEFRAME_D1'}
+
+def block_name(bus_name, channel):
+    """
+    Returns the shared memory block name of a channel.
+
+    Args:
+        bus_name (str): The name of the bus.
+        channel (str): The channel, e.g. "AAPL:1m".
+
+    Returns:
+        str: A name that is valid for shared memory on all platforms.
+    """
+    return re.sub(r'\W', '_', f"{bus_name}_{channel}")
+
+class MarketDataBus:
+    """
+    Shared memory ring buffers of the latest bars and tick per channel.
+
+    The feed process creates the bus with create=True and is its only
+    writer; strategy processes attach with the same name and channels.
+    """
+
+    def __init__(self, name, channels, capacity=4096, create=False, read_timeout=1.0):
+        """
+        Creates or attaches to the shared memory blocks of every channel.
+
+        Args:
+            name (str): The name of the bus.
+            channels (list): The channels, e.g. ["AAPL:1m", "EURUSD=X:1h"].
+            capacity (int): The number of bars kept per channel (creator only).
+            create (bool): True in the feed process, False in readers.
+            read_timeout (float): The seconds a read waits for a write in
+                progress before raising TimeoutError.
+        """
+        self.name = name
+        self.create = create
+        self.read_timeout = read_timeout
+        self._blocks = {}
+        self._headers = {}
+        self._bars = {}
+
+        for channel in channels:
+            if create:
+                size = HEADER_DTYPE.itemsize + 2 * capacity * BAR_DTYPE.itemsize
+                block = shared_memory.SharedMemory(block_name(name, channel), create=True, size=size)
+            else:
+                block = _attach(block_name(name, channel))
+            header = np.ndarray((1,), dtype=HEADER_DTYPE, buffer=block.buf)
+            if create:
+                header[0] = (0, 0, capacity, 0, np.nan, np.nan)
+            slots = 2 * int(header['capacity'][0])
+            self._blocks[channel] = block
+            self._headers[channel] = header
+            self._bars[channel] = np.ndarray((slots,), dtype=BAR_DTYPE, buffer=block.buf,
+                                             offset=HEADER_DTYPE.itemsize)
+
+    def publish_bars(self, channel, bars):
+        """
+        Appends bars to a channel; a bar with the time of the last published
+        bar replaces it, so a forming bar can be updated in place.
+
+        Args:
+            channel (str): The channel to write.
+            bars (np.ndarray): Bars with the BAR_DTYPE fields, oldest first.
+        """
+        header = self._headers[channel]
+        ring = self._bars[channel]
+        capacity = int(header['capacity'][0])
+
+        header['seq'] += 1
+        try:
+            count = int(header['count'][0])
+            for bar in np.asarray(bars, dtype=BAR_DTYPE):
+                if count and ring[(count - 1) % capacity]['time'] == bar['time']:
+                    count -= 1
+                elif count and ring[(count - 1) % capacity]['time'] > bar['time']:
+                    continue
+                slot = count % capacity
+                ring[slot] = bar
+                ring[slot + capacity] = bar
+                count += 1
+            header['count'] = count
+        finally:
+            # Even when interrupted, so readers are never locked out
+            header['seq'] += 1
+
+    def publish_tick(self, channel, tick_time, bid, ask):
+        """
+        Publishes the latest quote of a channel.
+
+        Args:
+            channel (str): The channel to write.
+            tick_time (int): The quote time in epoch seconds.
+            bid (float): The bid price.
+            ask (float): The ask price.
+        """
+        header = self._headers[channel]
+        header['seq'] += 1
+        try:
+            header['tick_time'] = tick_time
+            header['bid'] = bid
+            header['ask'] = ask
+        finally:
+            header['seq'] += 1
+
+    def sequence(self, channel):
+        """
+        Returns the write counter of a channel; it changes on every publish.
+
+        Args:
+            channel (str): The channel to read.
+
+        Returns:
+            int: The current sequence number.
+        """
+        return int(self._headers[channel]['seq'][0])
+
+    def latest_bars(self, channel, n, copy=False):
+        """
+        Returns the most recent bars of a channel as a zero-copy view.
+
+        The view stays valid until the feed has written another
+        capacity - n bars; pass copy=True for a snapshot that is checked
+        against concurrent writes.
+
+        Args:
+            channel (str): The channel to read.
+            n (int): The number of bars wanted.
+            copy (bool): Return a consistent copy instead of a view.
+
+        Returns:
+            np.ndarray: Up to n bars with the BAR_DTYPE fields, oldest first.
+        """
+        header = self._headers[channel]
+        ring = self._bars[channel]
+        capacity = int(header['capacity'][0])
+
+        def read():
+            count = int(header['count'][0])
+            size = min(n, count, capacity)
+            end = count % capacity + capacity
+            bars = ring[end - size:end]
+            return bars.copy() if copy else bars
+
+        return self._read_consistent(channel, read)
+
+    def latest_tick(self, channel):
+        """
+        Returns the most recent quote of a channel.
+
+        Args:
+            channel (str): The channel to read.
+
+        Returns:
+            tuple: The quote time, bid and ask.
+        """
+        header = self._headers[channel]
+        return self._read_consistent(channel, lambda: (int(header['tick_time'][0]),
+                                                       float(header['bid'][0]),
+                                                       float(header['ask'][0])))
+
+    def _read_consistent(self, channel, read):
+        """
+        Runs read() until no write overlapped it, sleeping briefly while a
+        write is in progress. Raises TimeoutError if the channel stays
+        mid-write for longer than read_timeout, e.g. because the feed died.
+
+        Args:
+            channel (str): The channel read.
+            read (callable): Reads the channel and returns the result.
+
+        Returns:
+            The result of read().
+        """
+        header = self._headers[channel]
+        deadline = None
+        delay = 0.0001
+        while True:
+            seq = int(header['seq'][0])
+            if seq % 2 == 0:
+                result = read()
+                if int(header['seq'][0]) == seq:
+                    return result
+            now = time.monotonic()
+            if deadline is None:
+                deadline = now + self.read_timeout
+            elif now > deadline:
+                raise TimeoutError(f"Channel {channel} of bus '{self.name}' has been mid-write for "
+                                   f"{self.read_timeout} s; is the feed still running?")
+            time.sleep(delay)
+            delay = min(delay * 2, 0.01)
+
+    def close(self):
+        """
+        Detaches from the bus; the feed process also removes the blocks.
+        """
+        headers = self._headers
+        self._headers = {}
+        self._bars = {}
+        del headers
+        for block in self._blocks.values():
+            block.close()
+            if self.create:
+                block.unlink()
+        self._blocks = {}
+
+def _attach(name):
+    """
+    Attaches to an existing block without letting Python unlink it when
+    this process exits (readers must not remove the feed's memory).
+
+    Args:
+        name (str): The block name.
+
+    Returns:
+        shared_memory.SharedMemory: The attached block.
+    """
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # Python < 3.13 always registers the block with the resource tracker
+        block = shared_memory.SharedMemory(name)
+        if sys.platform != 'win32':
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(block._name, 'shared_memory')
+        return block
+
+def yfinance_bars(channel):
+    """
+    Downloads the recent bars of a channel from Yahoo Finance.
+
+    Args:
+        channel (str): The channel, "<ticker>:<interval>".
+
+    Returns:
+        np.ndarray: The bars with the BAR_DTYPE fields, oldest first.
+    """
+    import yfinance as yf
+
+    ticker, interval = channel.rsplit(':', 1)
+    data = yf.download(tickers=ticker, period=FEED_PERIODS[interval], interval=interval)
+    close = data['Adj Close'] if 'Adj Close' in data else data['Close']
+    bars = np.empty(len(data), dtype=BAR_DTYPE)
+    bars['time'] = data.index.asi8 // 10**9
+    bars['open'] = data['Open']
+    bars['high'] = data['High']
+    bars['low'] = data['Low']
+    bars['close'] = close
+    bars['volume'] = data['Volume']
+    return bars
+
+def mt5_bars(channel, number_of_bars=1000):
+    """
+    Gets the recent bars of a channel from the MT5 terminal, which must
+    already be initialized.
+
+    Args:
+        channel (str): The channel, "<symbol>:<interval>".
+        number_of_bars (int): The number of bars to request.
+
+    Returns:
+        np.ndarray: The bars with the BAR_DTYPE fields, oldest first.
+    """
+    import MetaTrader5 as mt5
+
+    symbol, interval = channel.rsplit(':', 1)
+    rates = mt5.copy_rates_from_pos(symbol, getattr(mt5, MT5_TIMEFRAMES[interval]), 0, number_of_bars)
+    if rates is None:
+        raise RuntimeError(f"copy_rates_from_pos failed: {mt5.last_error()}")
+    bars = np.empty(len(rates), dtype=BAR_DTYPE)
+    for field in ('time', 'open', 'high', 'low', 'close'):
+        bars[field] = rates[field]
+    bars['volume'] = rates['tick_volume']
+    return bars
+
+def mt5_tick(channel):
+    """
+    Gets the latest quote of a channel's symbol from the MT5 terminal.
+
+    Args:
+        channel (str): The channel, "<symbol>:<interval>".
+
+    Returns:
+        tuple: The quote time, bid and ask.
+    """
+    import MetaTrader5 as mt5
+
+    symbol = channel.rsplit(':', 1)[0]
+    tick = mt5.symbol_info_tick(symbol)
+    if tick is None:
+        raise RuntimeError(f"symbol_info_tick failed: {mt5.last_error()}")
+    return tick.time, tick.bid, tick.ask
+
+def run_feed(channels, name="market_data", capacity=4096, interval=60, fetch=yfinance_bars,
+             quote=None):
+    """
+    Runs the feed process: fetches every channel once per interval and
+    publishes the bars and the latest quote to the bus.
+
+    Args:
+        channels (list): The channels to serve, e.g. ["AAPL:1m", "AAPL:1h"].
+        name (str): The name of the bus.
+        capacity (int): The number of bars kept per channel.
+        interval (float): The seconds between fetches.
+        fetch (callable): fetch(channel) returning BAR_DTYPE bars.
+        quote (callable): quote(channel) returning the quote time, bid and
+            ask, or None to publish the last close as both bid and ask.
+    """
+    bus = MarketDataBus(name, channels, capacity, create=True)
+    print(f"Market data bus '{name}' serving {', '.join(channels)}")
+    try:
+        while True:
+            for channel in channels:
+                try:
+                    bars = fetch(channel)
+                    bus.publish_bars(channel, bars)
+                    if quote is not None:
+                        bus.publish_tick(channel, *quote(channel))
+                    elif len(bars):
+                        bus.publish_tick(channel, bars['time'][-1], bars['close'][-1], bars['close'][-1])
+                except Exception as e:
+                    print(f"Failed to update {channel}: {e}")
+            time.sleep(interval)
+    finally:
+        bus.close()
+
+# Start the feed, e.g. python market_data_bus.py AAPL:1m AAPL:1h
+# or, from the MT5 terminal, python market_data_bus.py --mt5 EURUSD:1d
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args[:1] == ['--mt5']:
+        import MetaTrader5 as mt5
+        if not mt5.initialize():
+            print("MetaTrader 5 initialization failed")
+            quit()
+        run_feed(args[1:] or ["EURUSD:1d"], fetch=mt5_bars, quote=mt5_tick)
+    else:
+        run_feed(args or ["AAPL:1m", "AAPL:1h"])
@@ -0,0 +1,276 @@
+import threading
+import time
+import MetaTrader5 as mt5
+
+# One long-lived connection to the MT5 terminal per process. A heartbeat
+# checks the terminal every few seconds and reconnects with exponential
+# backoff when it dropped, so strategies keep their state instead of exiting.
+# Symbol metadata is cached, so sending an order needs no extra round trip.
+# Data and order requests go through call(), which holds the session lock,
+# so they never reach the terminal while it is being reinitialized.
+
+# Bits of SymbolInfo.filling_mode
+SYMBOL_FILLING_FOK = 1
+SYMBOL_FILLING_IOC = 2
+
+class MT5Session:
+    """
+    A persistent MT5 connection with cached symbol metadata.
+    """
+
+    def __init__(self, login=None, password=None, server=None, heartbeat_interval=5.0,
+                 max_backoff=60.0, symbol_ttl=300.0, terminal=mt5,
+                 clock=time.monotonic, sleep=time.sleep):
+        """
+        Args:
+            login (int): The account login ID, or None to use the account
+                the terminal is already logged in to.
+            password (str): The account password.
+            server (str): The trade server name.
+            heartbeat_interval (float): The seconds between connection checks.
+            max_backoff (float): The longest wait between reconnect attempts.
+            symbol_ttl (float): The seconds symbol metadata stays cached.
+            terminal (module): The MetaTrader5 module (replaceable in replays).
+            clock (callable): Returns the current time in seconds.
+            sleep (callable): Waits a number of seconds.
+        """
+        self.login = login
+        self.password = password
+        self.server = server
+        self.heartbeat_interval = heartbeat_interval
+        self.max_backoff = max_backoff
+        self.symbol_ttl = symbol_ttl
+        self.terminal = terminal
+        self.clock = clock
+        self.sleep = sleep
+        self.connected = False
+        self.reconnects = 0
+        self._last_check = None
+        self._symbols = {}  # (SymbolInfo, fetch time) by symbol
+        self._lock = threading.RLock()
+        self._reconnecting = threading.Lock()
+        self._heartbeat = None
+        self._stop = threading.Event()
+
+    def connect(self):
+        """
+        Initializes the terminal and logs in once.
+
+        Returns:
+            bool: True if connected.
+        """
+        with self._lock:
+            if not self.terminal.initialize():
+                print(f"MetaTrader 5 initialization failed. Error code: {self.terminal.last_error()}")
+                self.connected = False
+                return False
+            if self.login is not None and not self.terminal.login(login=self.login, password=self.password,
+                                                                  server=self.server):
+                print(f"Failed to log in to the broker. Error code: {self.terminal.last_error()}")
+                self.terminal.shutdown()
+                self.connected = False
+                return False
+            self.connected = True
+            self._last_check = self.clock()
+            return True
+
+    def reconnect(self, max_attempts=None):
+        """
+        Reconnects, waiting 1, 2, 4, ... seconds (at most max_backoff)
+        between attempts. Cached symbol metadata is dropped, as the
+        terminal may now be on another server.
+
+        Only one thread reconnects at a time; a call made while another
+        thread is reconnecting returns False at once instead of waiting.
+        The session lock is only held during each attempt, never while
+        sleeping, so other calls are not blocked by the backoff.
+
+        Args:
+            max_attempts (int): Give up after this many attempts, None to
+                keep trying.
+
+        Returns:
+            bool: True if connected.
+        """
+        if not self._reconnecting.acquire(blocking=False):
+            return False
+        try:
+            self.invalidate()
+            delay = 1.0
+            attempt = 0
+            while max_attempts is None or attempt < max_attempts:
+                with self._lock:
+                    self.terminal.shutdown()
+                    connected = self.connect()
+                if connected:
+                    self.reconnects += 1
+                    print("Reconnected to MetaTrader 5")
+                    return True
+                attempt += 1
+                if max_attempts is not None and attempt >= max_attempts:
+                    break
+                print(f"Retrying in {delay:.0f} seconds...")
+                self.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+            return False
+        finally:
+            self._reconnecting.release()
+
+    def ensure_connected(self, max_attempts=None):
+        """
+        Checks the terminal if the last check is older than the heartbeat
+        interval, and reconnects if the connection dropped.
+
+        Order paths should pass max_attempts=1 so an outage costs them at
+        most one reconnect attempt; the heartbeat keeps retrying with backoff.
+
+        Args:
+            max_attempts (int): The reconnect attempts, None to keep trying.
+
+        Returns:
+            bool: True if connected.
+        """
+        with self._lock:
+            now = self.clock()
+            if self.connected and self._last_check is not None and now - self._last_check < self.heartbeat_interval:
+                return True
+            info = self.terminal.terminal_info()
+            self._last_check = now
+            if info is not None and info.connected:
+                self.connected = True
+                return True
+            if self.connected:
+                print("MetaTrader 5 connection lost")
+            self.connected = False
+        return self.reconnect(max_attempts)
+
+    def start_heartbeat(self):
+        """
+        Checks the connection every heartbeat interval in a daemon thread,
+        so it is restored even while no order is being sent.
+        """
+        if self._heartbeat is not None and self._heartbeat.is_alive():
+            return
+
+        def beat():
+            while not self._stop.wait(self.heartbeat_interval):
+                try:
+                    self.ensure_connected()
+                except Exception as e:
+                    print(f"Heartbeat error: {e}")
+
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=beat, name="mt5-heartbeat", daemon=True)
+        self._heartbeat.start()
+
+    def stop_heartbeat(self):
+        """
+        Stops the heartbeat thread.
+        """
+        self._stop.set()
+        if self._heartbeat is not None and self._heartbeat is not threading.current_thread():
+            self._heartbeat.join()
+        self._heartbeat = None
+
+    def call(self, name, *args, **kwargs):
+        """
+        Calls a terminal function under the session lock, so data and order
+        requests never run while the heartbeat shuts the terminal down and
+        initializes it again.
+
+        Args:
+            name (str): The MetaTrader5 function, e.g. "order_send".
+            *args: The positional arguments of the function.
+            **kwargs: The keyword arguments of the function.
+
+        Returns:
+            The function's result.
+        """
+        with self._lock:
+            return getattr(self.terminal, name)(*args, **kwargs)
+
+    def symbol_info(self, symbol):
+        """
+        Returns the metadata of a symbol (point, digits, volume limits and
+        step, filling modes, ...), from the cache when it is fresh.
+
+        Args:
+            symbol (str): The symbol.
+
+        Returns:
+            SymbolInfo: The terminal's symbol info, or None if the symbol
+                is unknown.
+        """
+        now = self.clock()
+        cached = self._symbols.get(symbol)
+        if cached is not None and now - cached[1] < self.symbol_ttl:
+            return cached[0]
+
+        with self._lock:
+            info = self.terminal.symbol_info(symbol)
+            if info is not None and not info.visible:
+                # Symbols must be in Market Watch to be traded
+                self.terminal.symbol_select(symbol, True)
+            if info is None:
+                print(f"Failed to get symbol info for {symbol}. Error code: {self.terminal.last_error()}")
+                self._symbols.pop(symbol, None)
+                return None
+            self._symbols[symbol] = (info, now)
+            return info
+
+    def invalidate(self, symbol=None):
+        """
+        Drops cached symbol metadata, e.g. after the broker changed a
+        contract specification.
+
+        Args:
+            symbol (str): The symbol to drop, or None for all of them.
+        """
+        if symbol is None:
+            self._symbols.clear()
+        else:
+            self._symbols.pop(symbol, None)
+
+    def normalize_volume(self, symbol, volume):
+        """
+        Rounds a volume to the symbol's volume step within its limits.
+
+        Args:
+            symbol (str): The symbol.
+            volume (float): The wanted volume.
+
+        Returns:
+            float: The volume the server accepts.
+        """
+        info = self.symbol_info(symbol)
+        if info is None or not info.volume_step:
+            return volume
+        steps = round(volume / info.volume_step)
+        volume = round(steps * info.volume_step, 8)
+        return min(max(volume, info.volume_min), info.volume_max)
+
+    def filling_mode(self, symbol):
+        """
+        Returns the order filling type the symbol supports, preferring IOC.
+
+        Args:
+            symbol (str): The symbol.
+
+        Returns:
+            int: The MT5 ORDER_FILLING_* constant.
+        """
+        info = self.symbol_info(symbol)
+        if info is None or info.filling_mode & SYMBOL_FILLING_IOC:
+            return self.terminal.ORDER_FILLING_IOC
+        if info.filling_mode & SYMBOL_FILLING_FOK:
+            return self.terminal.ORDER_FILLING_FOK
+        return self.terminal.ORDER_FILLING_RETURN
+
+    def shutdown(self):
+        """
+        Stops the heartbeat and closes the terminal connection.
+        """
+        self.stop_heartbeat()
+        with self._lock:
+            self.terminal.shutdown()
+            self.connected = False
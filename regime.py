@@ -0,0 +1,223 @@
+import numpy as np
+import pandas as pd
+
+# Rolling market regime statistics for many symbols at once. Prices are
+# handled as (bars, symbols) matrices and every rolling window is read off
+# one cumulative sum, so the cost does not grow with the window length and
+# there is no Python loop over symbols, bars or windows.
+#
+# A Hurst exponent above 0.5 and a variance ratio above 1 mean moves tend to
+# continue (trend following applies); below 0.5 and 1 they tend to reverse
+# (mean reversion applies). Over finite windows both estimators come out
+# below those levels even for a random walk, so detect_regime compares them
+# with their expected random-walk values for the same window instead.
+
+TREND = 1
+MEAN_REVERSION = -1
+UNDECIDED = 0
+
+def _log_prices(prices):
+    """
+    Returns the log prices as a (bars, symbols) float array.
+    """
+    values = np.asarray(prices, dtype=float)
+    if values.ndim == 1:
+        values = values[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.log(values)
+
+def _wrap(result, prices):
+    """
+    Returns a (bars, symbols) result in the container type of prices.
+    """
+    if isinstance(prices, pd.DataFrame):
+        return pd.DataFrame(result, index=prices.index, columns=prices.columns)
+    if isinstance(prices, pd.Series):
+        return pd.Series(result[:, 0], index=prices.index, name=prices.name)
+    return result[:, 0] if np.ndim(prices) == 1 else result
+
+def _lagged_difference(values, lag):
+    """
+    Returns values[t] - values[t - lag], NaN for the first lag bars.
+    """
+    difference = np.full(values.shape, np.nan)
+    difference[lag:] = values[lag:] - values[:-lag]
+    return difference
+
+def _rolling_variance(values, windows):
+    """
+    Calculates the rolling sample variance of every column over every window.
+
+    Args:
+        values (np.ndarray): A (bars, symbols) array; NaN marks missing values.
+        windows (np.ndarray): The window lengths.
+
+    Returns:
+        np.ndarray: A (windows, bars, symbols) array, NaN until a window
+            holds no missing value.
+    """
+    missing = np.isnan(values)
+    filled = np.where(missing, 0.0, values)
+    zero = np.zeros((1, values.shape[1]))
+    sums = np.concatenate((zero, np.cumsum(filled, axis=0)))
+    squares = np.concatenate((zero, np.cumsum(filled * filled, axis=0)))
+    gaps = np.concatenate((zero, np.cumsum(missing, axis=0)))
+
+    end = np.arange(1, len(values) + 1)
+    start = end[None, :] - windows[:, None]
+    complete = start >= 0
+    start = np.maximum(start, 0)
+
+    n = windows[:, None, None].astype(float)
+    window_sum = sums[end][None] - sums[start]
+    window_squares = squares[end][None] - squares[start]
+    variance = (window_squares - window_sum * window_sum / n) / (n - 1)
+
+    valid = complete[:, :, None] & (gaps[end][None] - gaps[start] == 0)
+    return np.where(valid, np.maximum(variance, 0.0), np.nan)
+
+def rolling_variance_ratio(prices, windows=126, q=4):
+    """
+    Calculates the rolling variance ratio of q-bar to 1-bar log returns.
+
+    Args:
+        prices (pd.DataFrame, pd.Series or np.ndarray): Closes, one column
+            per symbol.
+        windows (int or list): The rolling window, or several of them.
+        q (int): The long return horizon in bars.
+
+    Returns:
+        The variance ratio shaped like prices, or a (windows, bars, symbols)
+        array when several windows are given. Around 1 for a random walk.
+    """
+    log_prices = _log_prices(prices)
+    window_list = np.atleast_1d(windows)
+    short_variance = _rolling_variance(_lagged_difference(log_prices, 1), window_list)
+    long_variance = _rolling_variance(_lagged_difference(log_prices, q), window_list)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = long_variance / (q * short_variance)
+
+    return ratio if np.ndim(windows) else _wrap(ratio[0], prices)
+
+def rolling_hurst(prices, windows=126, lags=(2, 4, 8, 16)):
+    """
+    Estimates the rolling Hurst exponent from how the spread of lagged log
+    price differences grows with the lag (std ~ lag ** H).
+
+    Args:
+        prices (pd.DataFrame, pd.Series or np.ndarray): Closes, one column
+            per symbol.
+        windows (int or list): The rolling window, or several of them.
+        lags (tuple): The lags of the log-log regression.
+
+    Returns:
+        The Hurst exponent shaped like prices, or a (windows, bars, symbols)
+        array when several windows are given. 0.5 for a random walk.
+    """
+    log_prices = _log_prices(prices)
+    window_list = np.atleast_1d(windows)
+    variances = np.stack([_rolling_variance(_lagged_difference(log_prices, lag), window_list)
+                          for lag in lags])
+
+    # Least squares slope of log std on log lag, for every window, bar and symbol at once
+    log_lags = np.log(np.asarray(lags, dtype=float))
+    weights = (log_lags - log_lags.mean()) / np.sum((log_lags - log_lags.mean()) ** 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hurst = np.tensordot(weights, 0.5 * np.log(variances), axes=1)
+
+    return hurst if np.ndim(windows) else _wrap(hurst[0], prices)
+
+def _random_walk_variance(window, lag):
+    """
+    Returns the expected rolling variance of lag-bar differences of a unit
+    step random walk over a window, and the expected log of it (to second
+    order), accounting for the overlap of the differences and the mean
+    removed within the window.
+    """
+    bars = np.arange(window)
+    covariance = np.maximum(lag - np.abs(bars[:, None] - bars[None, :]), 0).astype(float)
+    centered = covariance - covariance.mean(axis=0)
+    mean = np.trace(centered) / (window - 1)
+    variance = 2 * np.sum(centered * centered.T) / (window - 1) ** 2
+    return mean, np.log(mean) - variance / (2 * mean * mean)
+
+def random_walk_levels(window, lags=(2, 4, 8, 16), q=4):
+    """
+    Calculates what rolling_hurst and rolling_variance_ratio give for a
+    random walk over a window, and the standard error of the variance ratio.
+
+    Args:
+        window (int): The rolling window.
+        lags (tuple): The lags of the Hurst regression.
+        q (int): The long return horizon of the variance ratio.
+
+    Returns:
+        tuple: The expected Hurst exponent, the expected variance ratio and
+            its standard error.
+    """
+    log_lags = np.log(np.asarray(lags, dtype=float))
+    weights = (log_lags - log_lags.mean()) / np.sum((log_lags - log_lags.mean()) ** 2)
+    hurst = sum(weight * 0.5 * _random_walk_variance(window, lag)[1]
+                for weight, lag in zip(weights, lags))
+    ratio = _random_walk_variance(window, q)[0] / (q * _random_walk_variance(window, 1)[0])
+    # Lo and MacKinlay's standard error for overlapping q-bar returns
+    error = np.sqrt(2 * (2 * q - 1) * (q - 1) / (3 * q * window))
+    return hurst, ratio, error
+
+def detect_regime(prices, windows=126, lags=(2, 4, 8, 16), q=4, margin=0.05, errors=1.0):
+    """
+    Classifies every bar of every symbol as trending or mean reverting.
+
+    Both statistics are compared with their random-walk levels for the
+    window (see random_walk_levels). A bar is TREND when the Hurst exponent
+    is more than margin above its level and the variance ratio more than
+    errors standard errors above its level, MEAN_REVERSION when both are as
+    far below, and UNDECIDED otherwise or while the windows fill up. With
+    several windows, all of them must agree.
+
+    Args:
+        prices (pd.DataFrame, pd.Series or np.ndarray): Closes, one column
+            per symbol.
+        windows (int or list): The rolling window, or several of them.
+        lags (tuple): The lags of the Hurst regression.
+        q (int): The long return horizon of the variance ratio.
+        margin (float): The distance from its random-walk level the Hurst
+            exponent needs.
+        errors (float): The standard errors the variance ratio needs to be
+            away from its random-walk level.
+
+    Returns:
+        The regime (TREND, MEAN_REVERSION or UNDECIDED) shaped like prices.
+    """
+    window_list = list(np.atleast_1d(windows))
+    hurst = rolling_hurst(np.asarray(prices, dtype=float), window_list, lags)
+    ratio = rolling_variance_ratio(np.asarray(prices, dtype=float), window_list, q)
+
+    levels = np.array([random_walk_levels(window, lags, q) for window in window_list])
+    hurst_level, ratio_level, ratio_error = (levels[:, j, None, None] for j in range(3))
+    ratio_band = errors * ratio_error
+    trend = np.all((hurst > hurst_level + margin) & (ratio > ratio_level + ratio_band), axis=0)
+    reversion = np.all((hurst < hurst_level - margin) & (ratio < ratio_level - ratio_band), axis=0)
+    regime = np.where(trend, TREND, np.where(reversion, MEAN_REVERSION, UNDECIDED)).astype(np.int8)
+
+    return _wrap(regime, prices)
+
+def route_positions(regime, trend_position, reversion_position):
+    """
+    Picks the position of the rule set that applies in each regime.
+
+    While UNDECIDED both rules run, as without a regime filter: agreeing
+    signals are kept and opposite ones cancel out.
+
+    Args:
+        regime (np.ndarray): The regime of each bar.
+        trend_position (np.ndarray): The trend following position.
+        reversion_position (np.ndarray): The mean reversion position.
+
+    Returns:
+        np.ndarray: The routed position of each bar.
+    """
+    regime = np.asarray(regime)
+    both = np.clip(np.asarray(trend_position) + np.asarray(reversion_position), -1, 1)
+    return np.where(regime == TREND, trend_position,
+                    np.where(regime == MEAN_REVERSION, reversion_position, both))
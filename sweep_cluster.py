@@ -0,0 +1,495 @@
+import argparse
+import hmac
+import importlib
+import importlib.util
+import itertools
+import json
+import multiprocessing
+import os
+import socket
+import socketserver
+import threading
+import time
+from collections import deque
+import pandas as pd
+
+# Spreads a parameter sweep over many machines. The coordinator holds the
+# (symbol, parameters) tasks and serves them over plain TCP, one JSON
+# message per line; workers on any node connect, load the job function by
+# path and pull one task at a time, so faster nodes simply take more tasks.
+# Tasks of a worker that disconnects or stops answering are handed out
+# again, and every result is streamed back into one table.
+#
+# The coordinator listens on localhost unless given another interface. On
+# a network interface anyone who can connect could pull tasks and send back
+# made-up results, so set a shared token that workers must send.
+#
+# Protocol (worker -> coordinator / coordinator -> worker):
+#   {"type": "hello", "worker", "token"}     / {"type": "job", "job": spec}
+#   {"type": "ready"} or                     / {"type": "task", "id", "symbol", "params"}
+#   {"type": "job_error", "error": text}
+#                                              {"type": "wait", "seconds"} or {"type": "done"}
+#   {"type": "result", "id", "result": {...}} or {"type": "error", "id", "error": text}
+
+def make_tasks(symbols, param_grid):
+    """
+    Builds one task per symbol and parameter combination.
+
+    Args:
+        symbols (list): The symbols to backtest.
+        param_grid (dict): The candidate values for each parameter.
+
+    Returns:
+        list: The tasks, as dicts with the symbol and params.
+    """
+    names = list(param_grid)
+    return [{'symbol': symbol, 'params': dict(zip(names, values))}
+            for symbol in symbols
+            for values in itertools.product(*(param_grid[name] for name in names))]
+
+def load_job(spec):
+    """
+    Loads a job function from "path/to/file.py:function" or "module:function".
+
+    Args:
+        spec (str): The job spec.
+
+    Returns:
+        callable: job(symbol, **params) returning a dict of results.
+    """
+    location, name = spec.rsplit(':', 1)
+    if location.endswith('.py'):
+        module_name = os.path.splitext(os.path.basename(location))[0].replace(' ', '_').replace('.', '_')
+        module_spec = importlib.util.spec_from_file_location(module_name, location)
+        module = importlib.util.module_from_spec(module_spec)
+        module_spec.loader.exec_module(module)
+    else:
+        module = importlib.import_module(location)
+    return getattr(module, name)
+
+def _send(stream, message):
+    """
+    Writes one JSON message line and flushes it.
+    """
+    stream.write(json.dumps(message, default=float).encode() + b'\n')
+    stream.flush()
+
+def _receive(stream):
+    """
+    Reads one JSON message line, or returns None when the peer is gone.
+    """
+    line = stream.readline()
+    return json.loads(line) if line else None
+
+class _SweepServer(socketserver.ThreadingTCPServer):
+    """
+    The coordinator's TCP server; the port can be reused right after a restart.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+class SweepCoordinator:
+    """
+    Hands out sweep tasks to workers and collects their results.
+    """
+
+    def __init__(self, tasks, job, max_retries=3, task_timeout=600.0, on_result=None, token=None,
+                 job_error_timeout=30.0):
+        """
+        Args:
+            tasks (list): The tasks from make_tasks.
+            job (str): The job spec workers load with load_job.
+            max_retries (int): The number of times a lost or failed task is
+                handed out again before it is recorded as failed.
+            task_timeout (float): The seconds after which a task still
+                running is considered lost and handed out again.
+            on_result (callable): Optional on_result(row), called for every
+                finished task as its result arrives.
+            token (str): The shared secret workers must send, None to
+                accept any worker.
+            job_error_timeout (float): The seconds wait keeps going after a
+                worker failed to load the job while no other worker is
+                running it, before it gives up with a RuntimeError.
+        """
+        self.tasks = tasks
+        self.job = job
+        self.token = token
+        self.max_retries = max_retries
+        self.task_timeout = task_timeout
+        self.on_result = on_result
+        self.job_error_timeout = job_error_timeout
+        self.job_errors = []  # (worker, error) of workers that could not load the job
+        self.rows = {}
+        self._pending = deque(range(len(tasks)))
+        self._running = {}  # (worker, start time) by task id
+        self._attempts = [0] * len(tasks)
+        self._workers = 0  # Connected workers that loaded the job
+        self._idle_since = time.monotonic()
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+        self._server = None
+        if not tasks:
+            self._finished.set()
+
+    def next_task(self, worker):
+        """
+        Assigns the next task to a worker; lost tasks are retried first.
+
+        Args:
+            worker (str): The worker name.
+
+        Returns:
+            int: The task id, or None if no task is waiting.
+        """
+        with self._lock:
+            now = time.monotonic()
+            for task_id, (_, started) in list(self._running.items()):
+                if now - started > self.task_timeout:
+                    print(f"Task {task_id} timed out")
+                    self._retry(task_id, "timed out")
+            # A task retried after a timeout may have finished on its first worker
+            while self._pending and self._pending[0] in self.rows:
+                self._pending.popleft()
+            if not self._pending:
+                return None
+            task_id = self._pending.popleft()
+            self._attempts[task_id] += 1
+            self._running[task_id] = (worker, now)
+            return task_id
+
+    def complete(self, task_id, worker, result=None, error=None):
+        """
+        Records the result or error of a task. Results of tasks that were
+        already finished by another worker are ignored.
+
+        Args:
+            task_id (int): The task id.
+            worker (str): The worker name.
+            result (dict): The job result.
+            error (str): The error message if the job failed.
+        """
+        with self._lock:
+            if task_id in self.rows:
+                if self._running.get(task_id, (None,))[0] == worker:
+                    del self._running[task_id]
+                return
+            if error is not None:
+                print(f"Task {task_id} failed on {worker}: {error}")
+                self._retry(task_id, error)
+                return
+            started = self._running.pop(task_id, (worker, time.monotonic()))[1]
+            self._finish(task_id, {**result, 'worker': worker,
+                                   'seconds': time.monotonic() - started})
+
+    def release(self, worker):
+        """
+        Hands the running tasks of a disconnected worker out again.
+
+        Args:
+            worker (str): The worker name.
+        """
+        with self._lock:
+            for task_id, (owner, _) in list(self._running.items()):
+                if owner == worker:
+                    print(f"Worker {worker} lost, retrying task {task_id}")
+                    self._retry(task_id, f"worker {worker} lost")
+
+    def job_failed(self, worker, error):
+        """
+        Records a worker that could not load the job.
+
+        Args:
+            worker (str): The worker name.
+            error (str): The error message.
+        """
+        print(f"Worker {worker} could not load the job {self.job}: {error}")
+        with self._lock:
+            self.job_errors.append((worker, error))
+            if self._workers == 0:
+                self._idle_since = time.monotonic()
+
+    def _join(self):
+        """
+        Counts a worker that loaded the job.
+        """
+        with self._lock:
+            self._workers += 1
+
+    def _leave(self):
+        """
+        Uncounts a worker that loaded the job when it disconnects.
+        """
+        with self._lock:
+            self._workers -= 1
+            if self._workers == 0:
+                self._idle_since = time.monotonic()
+
+    def _job_unloadable(self):
+        """
+        Returns True once workers failed to load the job and none has been
+        running it for job_error_timeout seconds.
+        """
+        with self._lock:
+            return (bool(self.job_errors) and self._workers == 0
+                    and time.monotonic() - self._idle_since > self.job_error_timeout)
+
+    def _retry(self, task_id, reason):
+        """
+        Requeues a task, or records it as failed once out of retries.
+        """
+        self._running.pop(task_id, None)
+        if task_id in self.rows:
+            return
+        if self._attempts[task_id] > self.max_retries:
+            self._finish(task_id, {'error': reason})
+        else:
+            self._pending.appendleft(task_id)
+
+    def _finish(self, task_id, values):
+        """
+        Stores the row of a finished task.
+        """
+        task = self.tasks[task_id]
+        row = {'task': task_id, 'symbol': task['symbol'], **task['params'],
+               'attempts': self._attempts[task_id], **values}
+        self.rows[task_id] = row
+        if self.on_result is not None:
+            self.on_result(row)
+        if len(self.rows) == len(self.tasks):
+            self._finished.set()
+
+    def start(self, host="127.0.0.1", port=5555):
+        """
+        Starts serving tasks in a background thread.
+
+        Args:
+            host (str): The interface to listen on ("0.0.0.0" for all of
+                them, together with a token).
+            port (int): The TCP port (0 picks a free one).
+
+        Returns:
+            tuple: The address the coordinator listens on.
+        """
+        coordinator = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                hello = _receive(self.rfile)
+                if hello is None or hello.get('type') != 'hello':
+                    return
+                if coordinator.token is not None and not hmac.compare_digest(
+                        str(hello.get('token') or '').encode(), coordinator.token.encode()):
+                    print(f"Rejected worker from {self.client_address[0]}: wrong token")
+                    return
+                worker = f"{hello['worker']}@{self.client_address[0]}:{self.client_address[1]}"
+                joined = False
+                try:
+                    _send(self.wfile, {'type': 'job', 'job': coordinator.job})
+                    message = _receive(self.rfile)
+                    if message is None:
+                        return
+                    if message['type'] == 'job_error':
+                        coordinator.job_failed(worker, message['error'])
+                        return
+                    coordinator._join()
+                    joined = True
+                    while message is not None:
+                        if message['type'] == 'result':
+                            coordinator.complete(message['id'], worker, result=message['result'])
+                        elif message['type'] == 'error':
+                            coordinator.complete(message['id'], worker, error=message['error'])
+                        if coordinator._finished.is_set():
+                            _send(self.wfile, {'type': 'done'})
+                            break
+                        task_id = coordinator.next_task(worker)
+                        if task_id is None:
+                            _send(self.wfile, {'type': 'wait', 'seconds': 1.0})
+                        else:
+                            task = coordinator.tasks[task_id]
+                            _send(self.wfile, {'type': 'task', 'id': task_id,
+                                               'symbol': task['symbol'], 'params': task['params']})
+                        message = _receive(self.rfile)
+                except OSError:
+                    pass
+                finally:
+                    coordinator.release(worker)
+                    if joined:
+                        coordinator._leave()
+
+        self._server = _SweepServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server.server_address
+
+    def wait(self, timeout=None):
+        """
+        Waits until every task is finished and stops serving. Raises
+        RuntimeError if workers could not load the job and no worker ran it
+        for job_error_timeout seconds.
+
+        Args:
+            timeout (float): The longest wait in seconds, None for no limit.
+
+        Returns:
+            pd.DataFrame: One row per finished task, in task order, with the
+                symbol, parameters, job results, worker, attempts and seconds
+                (or an error column for tasks that ran out of retries).
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._finished.is_set():
+            remaining = 1.0 if deadline is None else deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if self._finished.wait(min(1.0, remaining)):
+                break
+            if self._job_unloadable():
+                self._stop_serving()
+                worker, error = self.job_errors[-1]
+                raise RuntimeError(f"No worker could load the job {self.job} "
+                                   f"({len(self.job_errors)} failed, last on {worker}: {error})")
+        self._stop_serving()
+        with self._lock:
+            return pd.DataFrame([self.rows[task_id] for task_id in sorted(self.rows)])
+
+    def _stop_serving(self):
+        """
+        Stops the server if it is running.
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+def run_coordinator(tasks, job, host="127.0.0.1", port=5555, max_retries=3, task_timeout=600.0,
+                    on_result=None, token=None, job_error_timeout=30.0):
+    """
+    Serves the tasks until all of them are finished.
+
+    Args:
+        tasks (list): The tasks from make_tasks.
+        job (str): The job spec workers load with load_job.
+        host (str): The interface to listen on.
+        port (int): The TCP port.
+        max_retries (int): The retries of a lost or failed task.
+        task_timeout (float): The seconds before a running task is retried.
+        on_result (callable): Optional on_result(row) for streamed results.
+        token (str): The shared secret workers must send.
+        job_error_timeout (float): The seconds to wait for a worker that can
+            load the job once others failed to.
+
+    Returns:
+        pd.DataFrame: The results table, see SweepCoordinator.wait.
+    """
+    coordinator = SweepCoordinator(tasks, job, max_retries, task_timeout, on_result, token,
+                                   job_error_timeout)
+    address = coordinator.start(host, port)
+    print(f"Sweep coordinator serving {len(tasks)} tasks on {address[0]}:{address[1]}")
+    return coordinator.wait()
+
+def run_worker(host, port, name=None, connect_timeout=30.0, token=None):
+    """
+    Runs tasks from a coordinator until it has none left.
+
+    Args:
+        host (str): The coordinator host.
+        port (int): The coordinator port.
+        name (str): The worker name (defaults to host name and process id).
+        connect_timeout (float): The seconds to keep trying to connect.
+        token (str): The shared secret of the coordinator.
+
+    Returns:
+        int: The number of tasks run.
+    """
+    name = name or f"{socket.gethostname()}-{os.getpid()}"
+    deadline = time.monotonic() + connect_timeout
+    while True:
+        try:
+            connection = socket.create_connection((host, port))
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
+
+    tasks_run = 0
+    with connection, connection.makefile('rwb') as stream:
+        _send(stream, {'type': 'hello', 'worker': name, 'token': token})
+        reply = _receive(stream)
+        if reply is None or reply['type'] != 'job':
+            raise ConnectionError(f"Coordinator at {host}:{port} refused the worker (wrong token?)")
+        try:
+            job = load_job(reply['job'])
+        except Exception as e:
+            # Tell the coordinator, so it does not wait for this worker forever
+            _send(stream, {'type': 'job_error', 'error': f"{type(e).__name__}: {e}"})
+            raise
+        _send(stream, {'type': 'ready'})
+        while True:
+            message = _receive(stream)
+            if message is None or message['type'] == 'done':
+                break
+            if message['type'] == 'wait':
+                time.sleep(message['seconds'])
+                _send(stream, {'type': 'ready'})
+                continue
+            try:
+                result = job(message['symbol'], **message['params'])
+                reply = {'type': 'result', 'id': message['id'], 'result': result}
+            except Exception as e:
+                reply = {'type': 'error', 'id': message['id'], 'error': f"{type(e).__name__}: {e}"}
+            _send(stream, reply)
+            tasks_run += 1
+    return tasks_run
+
+def run_workers(host, port, processes=None, token=None):
+    """
+    Runs one worker process per core of this node.
+
+    Args:
+        host (str): The coordinator host.
+        port (int): The coordinator port.
+        processes (int): The number of worker processes (defaults to the
+            number of cores).
+        token (str): The shared secret of the coordinator.
+    """
+    workers = [multiprocessing.Process(target=run_worker, args=(host, port, None, 30.0, token))
+               for _ in range(processes or os.cpu_count())]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+# On the coordinator node, e.g.
+#   SWEEP_TOKEN=<secret> python sweep_cluster.py coordinator --host 0.0.0.0 \
+#       --job "backtest.py:sweep_job" \
+#       --symbols EURUSD GBPUSD --grid '{"atr_period": [21, 42], "target_multiple": [5, 10]}'
+# and on every worker node (with the same code and data files)
+#   SWEEP_TOKEN=<secret> python sweep_cluster.py worker --host <coordinator host>
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distributed parameter sweeps")
+    parser.add_argument('mode', choices=['coordinator', 'worker'])
+    parser.add_argument('--host', default=None,
+                        help="Interface to listen on, or coordinator to connect to")
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--job', default='backtest.py:sweep_job')
+    parser.add_argument('--symbols', nargs='+', default=[])
+    parser.add_argument('--grid', default='{}', help="JSON dict of parameter values")
+    parser.add_argument('--out', default='sweep_results.csv')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--token', default=os.environ.get('SWEEP_TOKEN'),
+                        help="Shared secret of coordinator and workers (default: $SWEEP_TOKEN)")
+    args = parser.parse_args()
+
+    if args.mode == 'coordinator':
+        host = args.host or '127.0.0.1'
+        if args.token is None and host not in ('127.0.0.1', 'localhost', '::1'):
+            print(f"Warning: serving on {host} without --token, any host that can connect runs the job")
+        tasks = make_tasks(args.symbols, json.loads(args.grid))
+        try:
+            results = run_coordinator(tasks, args.job, host, args.port, token=args.token,
+                                      on_result=lambda row: print(json.dumps(row, default=float)))
+        except RuntimeError as e:
+            raise SystemExit(f"Sweep failed: {e}")
+        results.to_csv(args.out, index=False)
+        print(f"Saved {len(results)} results to {args.out}")
+    else:
+        run_workers(args.host or 'localhost', args.port, args.processes, args.token)
@@ -0,0 +1,86 @@
+import contextlib
+import io
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import backtest
+
+# The fast paths of backtest.py (chunked streaming, the vectorized crossover
+# grid and the result cache) must give the same answers as the plain
+# in-memory functions they replace.
+
+
+def ohlc(n=1500, seed=0):
+    rng = np.random.default_rng(seed)
+    close = 100 * np.exp(np.cumsum(rng.normal(0.0005, 0.01, n)))
+    open_ = np.r_[close[0], close[:-1]] * (1 + rng.normal(0, 0.002, n))
+    high = np.maximum(open_, close) * (1 + np.abs(rng.normal(0, 0.005, n)))
+    low = np.minimum(open_, close) * (1 - np.abs(rng.normal(0, 0.005, n)))
+    return pd.DataFrame({'date': pd.date_range('2000-01-01', periods=n, freq='D'),
+                         'open': open_, 'high': high, 'low': low, 'close': close,
+                         'tick_volume': rng.integers(1, 1000, n)})
+
+
+def chunked(df, size):
+    return (df.iloc[start:start + size] for start in range(0, len(df), size))
+
+
+@pytest.mark.parametrize('atr_period, target_multiple', [(42, 10), (2, 2)])
+@pytest.mark.parametrize('chunk_size', [1, 7, 100, 1000])
+def test_trend_following_chunks_match_in_memory(chunk_size, atr_period, target_multiple):
+    df = ohlc()
+    full = backtest.trend_following_strategy(df, atr_period, target_multiple)
+    streamed = pd.concat(backtest.trend_following_chunks(chunked(df, chunk_size),
+                                                         atr_period, target_multiple))
+
+    assert list(streamed.columns) == list(full.columns)
+    for column in full.columns:
+        expected = full[column].to_numpy()
+        actual = streamed[column].to_numpy()
+        if column == 'ATR':
+            # Rolling sums are restarted per chunk, so only ULPs may differ
+            np.testing.assert_allclose(actual, expected, rtol=1e-12)
+        elif column == 'entry_signal':
+            # The first bar has no previous high to break out of
+            assert list(actual[1:]) == list(expected[1:])
+        else:
+            np.testing.assert_array_equal(actual, expected, err_msg=column)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 100, 1000])
+def test_streaming_backtest_matches_performance_metrics(chunk_size):
+    df = ohlc()
+    expected = backtest.performance_metrics(backtest.trend_following_strategy(df, 2, 2))
+    with contextlib.redirect_stdout(io.StringIO()):
+        metrics = backtest.streaming_backtest(chunked(df, chunk_size), 2, 2)
+    assert metrics == expected
+
+
+def test_evaluate_crossover_grid_matches_crossover_strategy():
+    df = ohlc()
+    grid = backtest.evaluate_crossover_grid(df, [5, 10, 20, 42], [20, 50, 126], batch_size=3)
+
+    assert len(grid) == 10  # Pairs with short < long only
+    for row in grid.itertuples():
+        expected = backtest.performance_metrics(
+            backtest.crossover_strategy(df, row.short_window, row.long_window))
+        for name, value in expected.items():
+            assert getattr(row, name) == pytest.approx(value, rel=1e-9, abs=1e-12), \
+                (row.short_window, row.long_window, name)
+
+
+@pytest.mark.parametrize('strategy', ['trend_following', 'band', 'crossover', 'regime'])
+def test_cached_backtest_round_trip_keeps_dtypes(tmp_path, strategy):
+    df = ohlc(600)
+    missed_metrics, missed = backtest.cached_backtest(df, strategy, cache_dir=str(tmp_path))
+    hit_metrics, hit = backtest.cached_backtest(df, strategy, cache_dir=str(tmp_path))
+
+    assert len(list(tmp_path.glob('*.npz'))) == 1
+    assert hit_metrics == missed_metrics
+    pd.testing.assert_frame_equal(hit, missed)